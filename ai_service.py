@@ -1,19 +1,37 @@
 import os
+import re
+import math
+import time
 import logging
 import base64
+import signal
 import asyncio
+import threading
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
+from collections import deque, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+from typing import NamedTuple
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 from dotenv import load_dotenv
 
 # Библиотека Google
 from google import genai
-from google.genai import types
+from google.genai import types, errors
+
+from rate_limit import TokenBucket
+from deadline import DeadlineExceeded
+from image_cache import ImageCache, IMAGE_CACHE_TTL, image_key, prompt_group
+from card_templates import CardLayout, get_template
 
 load_dotenv()
 
 # --- КОНФИГУРАЦИЯ ---
 API_KEY = os.getenv("GOOGLE_API_KEY")
+# Несколько ключей (или проектов) через запятую - нагрузка распределяется между ними
+API_KEYS = [key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(",") if key.strip()] or ([API_KEY] if API_KEY else [])
 MODEL_NAME = "gemini-2.5-flash-image"
 
 # Конфигурация Canvas
@@ -26,6 +44,7 @@ FONT_PATH = "CinzelDecorative-Regular.ttf"
 # --- НОВЫЕ ЦВЕТА И РАЗМЕРЫ ---
 MAX_FONT_SIZE = 160    
 MIN_FONT_SIZE = 50     
+FONT_SIZE_STEP = 5
 
 # Текст: #4A3520 (Темно-коричневый)
 TEXT_COLOR = (74, 53, 32) 
@@ -42,12 +61,136 @@ TEXT_START_Y = 1150
 TEXT_MAX_WIDTH = 950      
 TEXT_MAX_HEIGHT = 700     
 
-# Инициализация клиента
-if API_KEY:
-    client = genai.Client(api_key=API_KEY)
-else:
-    logging.error("GOOGLE_API_KEY is missing!")
-    client = None
+# Макеты открыток: статический слой каждого рисуется один раз (card_templates)
+CARD_LAYOUTS = {
+    # Картинка сверху во всю ширину, текст на белом, рамка по краю
+    "classic": CardLayout(
+        name="classic",
+        canvas_size=CANVAS_SIZE,
+        bg_color=BG_COLOR,
+        image_box=(0, 0, *IMAGE_SIZE),
+        text_box=((CANVAS_SIZE[0] - TEXT_MAX_WIDTH) // 2, TEXT_START_Y, TEXT_MAX_WIDTH, TEXT_MAX_HEIGHT),
+        text_color=TEXT_COLOR,
+        frame_color=FRAME_COLOR,
+        frame_width=FRAME_WIDTH,
+    ),
+    # Как classic, но текст на кремовой панели с золотой обводкой
+    "panel": CardLayout(
+        name="panel",
+        canvas_size=CANVAS_SIZE,
+        bg_color=BG_COLOR,
+        image_box=(0, 0, *IMAGE_SIZE),
+        text_box=((CANVAS_SIZE[0] - TEXT_MAX_WIDTH) // 2, TEXT_START_Y, TEXT_MAX_WIDTH, TEXT_MAX_HEIGHT),
+        text_color=TEXT_COLOR,
+        frame_color=FRAME_COLOR,
+        frame_width=FRAME_WIDTH,
+        backdrop_color=(251, 246, 234),
+        backdrop_box=(40, 1120, CANVAS_SIZE[0] - 80, 760),
+        backdrop_radius=28,
+        backdrop_outline_width=3,
+    ),
+    # Картинка с полями и золотой линией вокруг на кремовом фоне
+    "inset": CardLayout(
+        name="inset",
+        canvas_size=CANVAS_SIZE,
+        bg_color=(251, 246, 234),
+        image_box=(60, 60, 960, 960),
+        text_box=(90, 1100, 900, 720),
+        text_color=TEXT_COLOR,
+        frame_color=FRAME_COLOR,
+        frame_width=FRAME_WIDTH,
+        image_border_width=4,
+    ),
+}
+DEFAULT_CARD_LAYOUT = os.getenv("CARD_LAYOUT", "classic")
+if DEFAULT_CARD_LAYOUT not in CARD_LAYOUTS:
+    logging.error(f"Неизвестный CARD_LAYOUT={DEFAULT_CARD_LAYOUT}, использую classic")
+    DEFAULT_CARD_LAYOUT = "classic"
+
+# Сжатие: лимит размера файла и сетка качества JPEG (95, 90, ... 15)
+JPEG_MAX_BYTES = 300 * 1024
+JPEG_QUALITY_MAX = 95
+JPEG_QUALITY_MIN = 15
+JPEG_QUALITY_STEP = 5
+
+
+class OutputFormat(NamedTuple):
+    """Один выходной файл открытки"""
+    image_format: str         # JPEG или WEBP
+    max_bytes: int            # лимит размера файла
+    shape: str = "card"       # card - открытка целиком, square - открытка на квадратном фоне, thumbnail - уменьшенная копия
+    size: tuple = None        # размер для square и thumbnail
+    progressive: bool = False
+
+
+# Все форматы собираются из одной отрисованной открытки - AI картинка декодируется один раз
+OUTPUT_FORMATS = {
+    # Открытка для Telegram (формат сторис)
+    "story": OutputFormat("JPEG", JPEG_MAX_BYTES),
+    "story_progressive": OutputFormat("JPEG", JPEG_MAX_BYTES, progressive=True),
+    "story_webp": OutputFormat("WEBP", 200 * 1024),
+    # Квадратный пост: открытка целиком на фоне макета
+    "square": OutputFormat("JPEG", 250 * 1024, shape="square", size=(1080, 1080)),
+    # Превью
+    "thumbnail": OutputFormat("JPEG", 30 * 1024, shape="thumbnail", size=(270, 480)),
+}
+DEFAULT_OUTPUT_FORMATS = ("story",)
+
+# Сборка открыток в отдельных процессах, чтобы Pillow не блокировал event loop.
+# COMPOSE_WORKERS=0 - собирать в потоке текущего процесса
+COMPOSE_WORKERS = int(os.getenv("COMPOSE_WORKERS", "2"))
+# Сколько открыток может одновременно собираться или ждать сборки
+COMPOSE_MAX_PENDING = int(os.getenv("COMPOSE_MAX_PENDING", str(max(1, COMPOSE_WORKERS) * 4)))
+# Место под готовый JPEG в разделяемой памяти (больше лимита на случай, если не удалось сжать)
+COMPOSE_OUTPUT_CAPACITY = 1024 * 1024
+# Сколько отрисованных текстовых блоков держать в кэше каждого процесса-сборщика
+TEXT_TILE_CACHE_SIZE = int(os.getenv("TEXT_TILE_CACHE_SIZE", "128"))
+
+# Таймаут для генерации изображения (60 секунд)
+IMAGE_GENERATION_TIMEOUT = 60
+# Меньше этого времени до дедлайна генерацию даже не начинаем - не успеет и только потратит квоту
+MIN_GENERATION_TIME = 8
+# Столько времени нужно оставить на сборку открытки
+MIN_COMPOSE_TIME = 2
+# Сколько секунд дедлайна генерация оставляет сборке открытки: с запасом сверх MIN_COMPOSE_TIME,
+# чтобы после истекшего ожидания генерации запасной фон еще успел собраться
+COMPOSE_RESERVE = MIN_COMPOSE_TIME + 1
+
+# Сколько запросов к Gemini может выполняться одновременно
+MAX_INFLIGHT_GENERATIONS = int(os.getenv("MAX_INFLIGHT_GENERATIONS", "8"))
+
+# Квота Gemini: запросы и картинки в минуту (по лимитам вашего тарифа)
+GEMINI_RPM_LIMIT = float(os.getenv("GEMINI_RPM_LIMIT", "10"))
+GEMINI_IMAGES_PER_MINUTE = float(os.getenv("GEMINI_IMAGES_PER_MINUTE", "10"))
+# Какую долю квоты используем: держимся чуть ниже лимита
+QUOTA_HEADROOM = 0.9
+# Пауза после 429, если сервер не сказал, сколько ждать (удваивается при повторных 429)
+QUOTA_DEFAULT_BACKOFF = 15
+QUOTA_MAX_BACKOFF = 120
+
+# Ключ, который подряд столько раз ответил ошибкой, выводится из ротации на KEY_COOLDOWN секунд
+KEY_FAILURE_THRESHOLD = 3
+KEY_COOLDOWN = 60
+# Ключ с ошибкой авторизации выводится надолго
+KEY_AUTH_COOLDOWN = 30 * 60
+# Сглаживание средней задержки ключа (EWMA)
+KEY_LATENCY_ALPHA = 0.2
+
+# Хеджирование: если запрос дольше p90 последних задержек, отправляем дублирующий
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_WINDOW = 100        # сколько последних задержек учитывать
+HEDGE_MIN_SAMPLES = 20    # до этого числа замеров не хеджируем
+HEDGE_PERCENTILE = 0.9
+
+# Автомат (circuit breaker): при доле ошибок выше порога генерации отклоняются сразу
+BREAKER_WINDOW = 20
+BREAKER_MIN_SAMPLES = 10
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN = 30
+
+# Одинаковые запросы, пришедшие одновременно, делят один вызов Gemini.
+# Сколько запросов может разделить один вызов; 1 - не объединять
+COALESCE_FANOUT = int(os.getenv("COALESCE_FANOUT", "5"))
 
 # Настройки безопасности
 SAFETY_SETTINGS = [
@@ -57,59 +200,601 @@ SAFETY_SETTINGS = [
     types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_LOW_AND_ABOVE"),
 ]
 
-# Таймаут для генерации изображения (60 секунд)
-IMAGE_GENERATION_TIMEOUT = 60
+GENERATION_CONFIG = types.GenerateContentConfig(
+    response_modalities=["IMAGE"],
+    safety_settings=SAFETY_SETTINGS,
+    image_config=types.ImageConfig(aspect_ratio="1:1")
+)
+
+# Ограничение одновременных запросов к Gemini
+_generation_slots = asyncio.Semaphore(max(1, MAX_INFLIGHT_GENERATIONS))
+
+class QuotaGovernor:
+    """
+    Распределяет квоту Gemini между всеми запросами процесса.
+    Запросы и картинки в минуту идут через token bucket'ы чуть ниже лимита, а ответ
+    429 / RESOURCE_EXHAUSTED ставит на паузу всех сразу, а не отдельного пользователя.
+    """
+
+    def __init__(self, rpm: float = GEMINI_RPM_LIMIT, images_per_minute: float = GEMINI_IMAGES_PER_MINUTE, name: str = "gemini"):
+        self.name = name
+        self._requests = self._bucket(rpm)
+        self._images = self._bucket(images_per_minute)
+        self._consecutive_limits = 0
 
-def _generate_image_sync(positive_prompt: str):
-    """Синхронная функция для генерации изображения"""
-    return client.models.generate_content(
-        model=MODEL_NAME,
-        contents=positive_prompt,
-        config=types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            safety_settings=SAFETY_SETTINGS,
-            image_config=types.ImageConfig(aspect_ratio="1:1")
+    @staticmethod
+    def _bucket(per_minute: float) -> TokenBucket:
+        rate = per_minute * QUOTA_HEADROOM / 60
+        # Небольшой запас на всплеск, но без накопления пачки на всю минуту
+        return TokenBucket(rate=rate, capacity=max(1, per_minute * QUOTA_HEADROOM / 10))
+
+    async def acquire(self):
+        """Ждет, пока квота позволит отправить запрос (и получить одну картинку)"""
+        await self._requests.acquire()
+        await self._images.acquire()
+
+    def record_success(self):
+        self._consecutive_limits = 0
+
+    def record_rate_limited(self, retry_after: float = None):
+        """Сервер ответил 429: ставим на паузу все запросы"""
+        self._consecutive_limits += 1
+        if retry_after is None:
+            retry_after = min(QUOTA_MAX_BACKOFF, QUOTA_DEFAULT_BACKOFF * 2 ** (self._consecutive_limits - 1))
+        self._requests.pause(retry_after)
+        self._images.pause(retry_after)
+        logging.warning(f"🚦 Gemini quota exhausted ({self.name}), pausing its generations for {retry_after:.0f}s")
+
+    @property
+    def headroom(self) -> float:
+        """Сколько запросов можно отправить прямо сейчас без ожидания"""
+        return min(self._requests.available, self._images.available)
+
+    @property
+    def paused_for(self) -> float:
+        return max(self._requests.paused_for, self._images.paused_for)
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    return isinstance(error, errors.APIError) and (error.code == 429 or error.status == "RESOURCE_EXHAUSTED")
+
+def _retry_delay(error: errors.APIError):
+    """Сколько ждать по мнению сервера: заголовок Retry-After или RetryInfo.retryDelay в ответе"""
+    headers = getattr(error.response, "headers", None) or {}
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    match = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", str(error.details))
+    return float(match.group(1)) if match else None
+
+def _is_auth_error(error: Exception) -> bool:
+    return isinstance(error, errors.APIError) and error.code in (401, 403)
+
+class ApiKeySlot:
+    """Один API ключ: свой клиент, своя квота, средняя задержка и состояние автомата."""
+
+    def __init__(self, api_key: str, index: int):
+        self.name = f"key#{index} (…{api_key[-4:]})"
+        # Таймаут транспорта - страховка на случай, если запрос не отменили сверху
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=IMAGE_GENERATION_TIMEOUT * 1000)
         )
-    )
+        self.governor = QuotaGovernor(name=self.name)
+        self.latency = None          # EWMA задержки успешных запросов, секунды
+        self.inflight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0        # до этого момента ключ выведен из ротации
 
-async def generate_image_bytes(positive_prompt: str) -> BytesIO:
-    if not client: return None
-    try:
-        logging.info(f"🎨 Generating base AI image...")
-        
-        # Запускаем генерацию в отдельном потоке с таймаутом
-        loop = asyncio.get_event_loop()
-        response = await asyncio.wait_for(
-            loop.run_in_executor(None, _generate_image_sync, positive_prompt),
-            timeout=IMAGE_GENERATION_TIMEOUT
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше: ожидаемая задержка с учетом запросов в работе, ошибок и паузы по квоте"""
+        latency = self.latency if self.latency is not None else IMAGE_GENERATION_TIMEOUT / 4
+        return latency * (1 + self.inflight) * (1 + self.consecutive_failures) + self.governor.paused_for
+
+    def record_success(self, latency: float):
+        self.consecutive_failures = 0
+        self.latency = latency if self.latency is None else (
+            KEY_LATENCY_ALPHA * latency + (1 - KEY_LATENCY_ALPHA) * self.latency
         )
-        
-        if not response.candidates or not response.candidates[0].content.parts: 
-            logging.warning("No candidates or parts in response")
+
+    def record_failure(self, error: Exception = None):
+        self.consecutive_failures += 1
+        if _is_auth_error(error):
+            self._drain(KEY_AUTH_COOLDOWN, f"auth error: {error}")
+        elif self.consecutive_failures >= KEY_FAILURE_THRESHOLD:
+            self._drain(KEY_COOLDOWN, f"{self.consecutive_failures} failures in a row")
+
+    def _drain(self, seconds: float, reason: str):
+        self.open_until = time.monotonic() + seconds
+        # После паузы ключ получает одну пробную попытку: одна ошибка - снова в паузу
+        self.consecutive_failures = KEY_FAILURE_THRESHOLD - 1
+        logging.warning(f"🔌 Gemini {self.name} drained for {seconds:.0f}s: {reason}")
+
+class ApiKeyPool:
+    """Набор API ключей: запрос уходит на самый здоровый ключ, у которого есть запас квоты."""
+
+    def __init__(self, api_keys):
+        self.slots = [ApiKeySlot(key, index) for index, key in enumerate(api_keys, start=1)]
+
+    def __bool__(self):
+        return bool(self.slots)
+
+    def choose(self) -> ApiKeySlot:
+        candidates = [slot for slot in self.slots if slot.available]
+        if not candidates:
+            # Все ключи выведены - берем тот, который вернется раньше остальных
+            return min(self.slots, key=lambda slot: slot.open_until)
+        with_headroom = [slot for slot in candidates if slot.governor.headroom >= 1]
+        return min(with_headroom or candidates, key=lambda slot: slot.score())
+
+    async def acquire(self) -> ApiKeySlot:
+        """Выбирает ключ и ждет его квоту"""
+        slot = self.choose()
+        slot.inflight += 1
+        try:
+            await slot.governor.acquire()
+        except BaseException:
+            slot.inflight -= 1
+            raise
+        return slot
+
+    def release(self, slot: ApiKeySlot):
+        slot.inflight -= 1
+
+key_pool = ApiKeyPool(API_KEYS)
+if not key_pool:
+    logging.error("GOOGLE_API_KEY is missing!")
+
+def _extract_image_bytes(response):
+    """Достает байты картинки из ответа Gemini"""
+    if not response.candidates or not response.candidates[0].content.parts: 
+        logging.warning("No candidates or parts in response")
+        return None
+
+    for part in response.candidates[0].content.parts:
+        if part.inline_data:
+            return part.inline_data.data if isinstance(part.inline_data.data, bytes) else base64.b64decode(part.inline_data.data)
+    return None
+
+class CircuitOpenError(Exception):
+    """Генерация временно отключена: слишком много ошибок Gemini подряд"""
+
+class CircuitBreaker:
+    """
+    Следит за долей ошибок последних запросов. Если она выше порога, размыкается на
+    BREAKER_COOLDOWN секунд: запросы отклоняются сразу. Потом пропускает один пробный запрос.
+    """
+
+    def __init__(self):
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)
+        self._open_until = 0.0
+        # Номер текущего пробного запроса (0 - пробы нет)
+        self._probe = 0
+        self._probe_count = 0
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def admit(self):
+        """
+        Разрешение на генерацию: None - нельзя (цепь разомкнута или уже идет проба),
+        0 - обычная генерация, число больше 0 - номер пробного запроса полуоткрытого состояния.
+        Номер пробы передается в record и release_probe.
+        """
+        if self.is_open:
             return None
+        if self._open_until:
+            if self._probe:
+                return None
+            # Полуоткрытое состояние: пропускаем ровно один пробный запрос
+            self._probe_count += 1
+            self._probe = self._probe_count
+            return self._probe
+        return 0
 
-        image_bytes = None
-        for part in response.candidates[0].content.parts:
-            if part.inline_data:
-                image_bytes = part.inline_data.data if isinstance(part.inline_data.data, bytes) else base64.b64decode(part.inline_data.data)
-                break
-        
-        return BytesIO(image_bytes) if image_bytes else None
-    except asyncio.TimeoutError:
-        logging.error(f"⏱️ Timeout: Image generation exceeded {IMAGE_GENERATION_TIMEOUT} seconds")
+    def release_probe(self, probe: int):
+        """Снимает пробу, которая закончилась без исхода (дедлайн, отмена) - следующая генерация станет пробой"""
+        if probe and probe == self._probe:
+            self._probe = 0
+
+    def record(self, success, probe: int = 0):
+        """
+        success: True/False - исход запроса, None - запрос не показателен (429, отмена).
+        probe - номер пробы, если запрос пробный.
+        """
+        if probe:
+            # Хеджированный дубль пробы, чей исход уже учтен, ничего не меняет
+            if probe != self._probe:
+                return
+            if success is None:
+                return
+            self._probe = 0
+            if success:
+                self._open_until = 0.0
+                self._outcomes.clear()
+            else:
+                self._trip()
+            return
+        # Пока цепь разомкнута или идет проба, ответы запросов, начатых до размыкания, не учитываем
+        if success is None or self._open_until:
+            return
+        self._outcomes.append(success)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= BREAKER_MIN_SAMPLES and failures / len(self._outcomes) >= BREAKER_ERROR_RATE:
+            self._trip()
+
+    def _trip(self):
+        self._open_until = time.monotonic() + BREAKER_COOLDOWN
+        self._outcomes.clear()
+        logging.error(f"⛔ Gemini circuit breaker open for {BREAKER_COOLDOWN}s")
+
+circuit_breaker = CircuitBreaker()
+
+# Задержки последних успешных запросов - для порога хеджирования
+_latencies = deque(maxlen=HEDGE_WINDOW)
+
+def _hedge_delay():
+    """Через сколько секунд отправлять дублирующий запрос (p90) или None, если не хеджируем"""
+    if not HEDGE_ENABLED or len(_latencies) < HEDGE_MIN_SAMPLES:
         return None
-    except Exception as e:
-        logging.error(f"Generate Error: {e}")
+    ordered = sorted(_latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+
+def _can_hedge() -> bool:
+    """Дубль отправляем только на свободную квоту, чтобы не отнимать ее у очереди"""
+    return not circuit_breaker.is_open and any(
+        slot.available and slot.governor.headroom >= 1 for slot in key_pool.slots
+    )
+
+async def _request_image(positive_prompt: str, probe: int = 0):
+    """Один запрос к Gemini через пул ключей. Возвращает байты картинки или None."""
+    async with _generation_slots:
+        slot = await key_pool.acquire()
+        started = time.monotonic()
+        outcome = None
+        try:
+            logging.info(f"🎨 Generating base AI image via {slot.name}...")
+            
+            # Асинхронный клиент: при таймауте или отмене запрос действительно прерывается,
+            # а не продолжает висеть в потоке executor'а
+            response = await asyncio.wait_for(
+                slot.client.aio.models.generate_content(
+                    model=MODEL_NAME,
+                    contents=positive_prompt,
+                    config=GENERATION_CONFIG
+                ),
+                timeout=IMAGE_GENERATION_TIMEOUT
+            )
+            
+            image_bytes = _extract_image_bytes(response)
+            latency = time.monotonic() - started
+            slot.record_success(latency)
+            outcome = True
+            if image_bytes:
+                slot.governor.record_success()
+                _latencies.append(latency)
+            return image_bytes
+        except asyncio.TimeoutError:
+            slot.record_failure()
+            outcome = False
+            logging.error(f"⏱️ Timeout: Image generation exceeded {IMAGE_GENERATION_TIMEOUT} seconds ({slot.name})")
+            return None
+        except Exception as e:
+            if _is_rate_limit_error(e):
+                # Квота ключа - не признак его неисправности
+                slot.governor.record_rate_limited(_retry_delay(e))
+                return None
+            slot.record_failure(e)
+            outcome = False
+            logging.error(f"Generate Error ({slot.name}): {e}")
+            return None
+        finally:
+            key_pool.release(slot)
+            circuit_breaker.record(outcome, probe)
+
+async def _request_image_hedged(positive_prompt: str, probe: int = 0):
+    """
+    Запрос с хеджированием: если ответа нет дольше p90 обычной задержки, отправляем
+    второй запрос и берем тот, что первым вернет картинку; второй отменяется.
+    """
+    tasks = {asyncio.create_task(_request_image(positive_prompt, probe))}
+    try:
+        delay = _hedge_delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and _can_hedge():
+                logging.info(f"🪢 Hedging image generation after {delay:.1f}s")
+                tasks.add(asyncio.create_task(_request_image(positive_prompt, probe)))
+
+        # Ошибка одной копии не отменяет другую, которая еще может вернуть картинку;
+        # бросаем ее, только когда копий не осталось
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    image_bytes = task.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if image_bytes:
+                    return image_bytes
+        if error:
+            raise error
         return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# --- ДИСКОВЫЙ КЭШ ФОНОВ ---
+image_cache = ImageCache()
+
+async def load_image_cache():
+    """Читает индекс дискового кэша (вызывается при старте бота)"""
+    await asyncio.to_thread(image_cache.load)
+
+def save_image_cache():
+    image_cache.save()
+
+def _cached_keys(prompts) -> list:
+    """Ключи кэша всех промптов вместе, от свежих к старым: [(возраст в секундах, ключ)]"""
+    aged = []
+    # Один проход по индексу на все промпты; find уже сортирует от свежих к старым
+    for key in image_cache.find(*(prompt_group(MODEL_NAME, prompt) for prompt in prompts)):
+        age = image_cache.age(key)
+        if age is not None:
+            aged.append((age, key))
+    return aged
+
+async def cached_background(prompts) -> BytesIO:
+    """
+    Самый свежий закэшированный фон моложе IMAGE_CACHE_TTL сразу по нескольким промптам
+    (всем вариантам темы) или None.
+    Только для аварийного режима, когда Gemini не смог сгенерировать новый фон.
+    """
+    if not image_cache.enabled:
+        return None
+    for age, key in _cached_keys(prompts):
+        if age > IMAGE_CACHE_TTL:
+            break
+        image_bytes = await asyncio.to_thread(image_cache.get, key, IMAGE_CACHE_TTL)
+        if image_bytes:
+            return BytesIO(image_bytes)
+    return None
+
+async def cached_backgrounds(prompts, limit: int = None) -> list:
+    """
+    Самые свежие закэшированные фоны сразу по нескольким промптам (например, всем вариантам темы),
+    от свежих к старым: [(bytes, возраст в секундах)]. С диска читается не больше limit картинок.
+    """
+    if not image_cache.enabled:
+        return []
+    images = []
+    for age, key in _cached_keys(prompts):
+        if limit is not None and len(images) >= limit:
+            break
+        image_bytes = await asyncio.to_thread(image_cache.get, key)
+        if image_bytes:
+            images.append((image_bytes, age))
+    return images
+
+async def _generate(positive_prompt: str):
+    probe = circuit_breaker.admit()
+    if probe is None:
+        raise CircuitOpenError("Gemini circuit breaker is open")
+    try:
+        image_bytes = await _request_image_hedged(positive_prompt, probe)
+    finally:
+        # Проба могла закончиться до ответа Gemini (ожидание квоты, отмена) -
+        # иначе цепь осталась бы полуоткрытой навсегда
+        circuit_breaker.release_probe(probe)
+    if image_bytes and image_cache.enabled:
+        # Каждая картинка - своя запись: новые фоны не затирают предыдущие того же промпта
+        await asyncio.to_thread(
+            image_cache.put, image_key(MODEL_NAME, positive_prompt, image_bytes), image_bytes,
+            prompt_group(MODEL_NAME, positive_prompt)
+        )
+    return image_bytes
+
+# --- ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ (single-flight) ---
+
+class _Flight:
+    """Один вызов Gemini, результат которого ждут несколько запросов"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+# (prompt, variant) -> list[_Flight] вызовов, которые еще выполняются
+_flights = {}
+
+def _finish_flight(key, flight: _Flight):
+    flights = _flights.get(key)
+    if flights and flight in flights:
+        flights.remove(flight)
+        if not flights:
+            del _flights[key]
+    # Забираем исключение, даже если его уже некому получить
+    if not flight.task.cancelled():
+        flight.task.exception()
+
+def _join_flight(key, positive_prompt: str, deadline=None) -> _Flight:
+    """Присоединяет запрос к наименее загруженному вызову с тем же ключом или начинает новый"""
+    flights = _flights.setdefault(key, [])
+    open_flights = [f for f in flights if f.waiters < COALESCE_FANOUT]
+    if open_flights:
+        flight = min(open_flights, key=lambda f: f.waiters)
+        logging.info(f"🔗 Joining in-flight image generation ({flight.waiters + 1} requests share it)")
+        return flight
+    if deadline:
+        deadline.ensure(MIN_GENERATION_TIME, "image generation")
+    # Вызов общий, поэтому идет без дедлайна создателя: иначе ожидание квоты и таймаут запроса
+    # обрывались бы по его дедлайну у всех. Каждый ожидающий ограничен своим дедлайном в
+    # generate_image_bytes, а когда уходит последний, вызов отменяется
+    flight = _Flight(asyncio.create_task(_generate(positive_prompt)))
+    flights.append(flight)
+    flight.task.add_done_callback(lambda _: _finish_flight(key, flight))
+    return flight
+
+async def generate_image_bytes(positive_prompt: str, deadline=None, variant=None) -> BytesIO:
+    """
+    Генерирует новую AI картинку. Возвращает BytesIO или None при ошибке.
+    Результат сохраняется в дисковый кэш - из него наполняется пул после перезапуска
+    и берется фон в аварийном режиме (cached_background), но сюда кэш не подмешивается.
+    Одновременные запросы с тем же промптом и вариантом получают результат одного вызова
+    (не больше COALESCE_FANOUT запросов на вызов); variant - ключ вариации, например
+    пользователя, запросы с разными вариантами не объединяются.
+    Бросает CircuitOpenError, если Gemini сейчас массово отвечает ошибками,
+    и DeadlineExceeded, если генерация уже не успеет до дедлайна.
+    """
+    if not key_pool: return None
+    flight = _join_flight((positive_prompt, variant), positive_prompt, deadline)
+    flight.waiters += 1
+    try:
+        # Каждый ждет в пределах своего дедлайна; уход одного не отменяет вызов для остальных
+        image_bytes = await asyncio.wait_for(
+            asyncio.shield(flight.task), timeout=deadline.remaining() if deadline else None
+        )
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("deadline expired while waiting for image generation")
+    finally:
+        flight.waiters -= 1
+        if not flight.waiters and not flight.task.done():
+            flight.task.cancel()
+    # Каждому запросу - свой BytesIO над общими байтами
+    return BytesIO(image_bytes) if image_bytes else None
 
 # --- УМНАЯ РАБОТА С ТЕКСТОМ ---
 
+@lru_cache(maxsize=None)
+def get_font(size: int):
+    """Загружает шрифт нужного размера один раз на весь процесс."""
+    return ImageFont.truetype(FONT_PATH, size)
+
+class GlyphMetrics:
+    """
+    Таблица метрик глифов для одного размера шрифта.
+    Ширина строки считается арифметикой по закэшированным advance/bbox глифов и
+    кернинг-парам - так же, как базовая раскладка Pillow (совпадает с textbbox).
+    """
+    # Печатные ASCII-символы считаем сразу, остальные - по мере появления
+    PRELOAD_CHARS = "".join(chr(code) for code in range(32, 127))
+
+    def __init__(self, font):
+        self.font = font
+        self._glyphs = {}   # символ -> (advance, x0, x1)
+        self._kerning = {}  # (символ, символ) -> поправка к advance
+        for ch in self.PRELOAD_CHARS:
+            self._glyph(ch)
+        self._runs = {}     # слово -> отрезок (см. run)
+
+    def _glyph(self, ch):
+        glyph = self._glyphs.get(ch)
+        if glyph is None:
+            x0, _, x1, _ = self.font.getbbox(ch)
+            glyph = (self.font.getlength(ch), x0, x1)
+            self._glyphs[ch] = glyph
+        return glyph
+
+    def _kern(self, left, right):
+        pair = (left, right)
+        value = self._kerning.get(pair)
+        if value is None:
+            value = self.font.getlength(left + right) - self._glyph(left)[0] - self._glyph(right)[0]
+            self._kerning[pair] = value
+        return value
+
+    def run(self, text):
+        """
+        Метрики отрезка текста от пера в нуле: (advance, x0, x1, первый символ, последний символ).
+        Отрезки склеиваются через join() без повторного измерения.
+        """
+        cached = self._runs.get(text)
+        if cached is not None:
+            return cached
+        result = None
+        for ch in text:
+            advance, x0, x1 = self._glyph(ch)
+            result = self.join(result, (advance, x0, x1, ch, ch))
+        if len(self._runs) < 4096:
+            self._runs[text] = result
+        return result
+
+    def join(self, left, right):
+        """Склеивает два отрезка с учетом кернинга на стыке"""
+        if left is None: return right
+        if right is None: return left
+        pen = left[0] + self._kern(left[4], right[3])
+        return (
+            pen + right[0],
+            min(left[1], pen + right[1]),
+            max(left[2], pen + right[2]),
+            left[3],
+            right[4],
+        )
+
+    @staticmethod
+    def width(run):
+        """Ширина отрезка, как bbox[2] - bbox[0] у textbbox"""
+        return run[2] - run[1] if run else 0
+
+    def text_width(self, text):
+        return self.width(self.run(text))
+
+@lru_cache(maxsize=None)
+def _glyph_metrics_for_size(size: int) -> GlyphMetrics:
+    return GlyphMetrics(get_font(size))
+
+def get_glyph_metrics(font):
+    """
+    Метрики для шрифта открытки или None, если шрифт другой (load_default)
+    или используется раскладка RAQM, которую арифметикой не повторить.
+    """
+    if getattr(font, "path", None) != FONT_PATH or font.layout_engine != ImageFont.Layout.BASIC:
+        return None
+    return _glyph_metrics_for_size(font.size)
+
+def measure_text_width(text, font, draw_obj):
+    """Ширина строки: по таблице глифов, если она доступна, иначе через textbbox"""
+    metrics = get_glyph_metrics(font)
+    if metrics:
+        return metrics.text_width(text)
+    bbox = draw_obj.textbbox((0, 0), text, font=font)
+    return bbox[2] - bbox[0]
+
 def wrap_text(text, font, max_width, draw_obj):
     """Разбивает текст на строки."""
     lines = []
     words = text.split()
     if not words: return []
     
+    metrics = get_glyph_metrics(font)
+    if metrics:
+        # Ширину строки наращиваем по словам, а не измеряем всю строку заново
+        space = metrics.run(" ")
+        current_line = words[0]
+        current_run = metrics.run(current_line)
+        for word in words[1:]:
+            word_run = metrics.run(word)
+            test_run = metrics.join(metrics.join(current_run, space), word_run)
+            if metrics.width(test_run) <= max_width:
+                current_line = current_line + " " + word
+                current_run = test_run
+            else:
+                lines.append(current_line)
+                current_line = word
+                current_run = word_run
+        lines.append(current_line)
+        return lines
+    
     current_line = words[0]
     for word in words[1:]:
         test_line = current_line + " " + word
@@ -132,88 +817,440 @@ def get_text_block_size(lines, font, draw_obj):
     total_height = len(lines) * line_height
     return total_height, line_height
 
-async def compose_final_card(ai_image_io: BytesIO, user_text: str) -> BytesIO:
+def fit_text(text, draw_obj, max_width: int = TEXT_MAX_WIDTH, max_height: int = TEXT_MAX_HEIGHT):
+    """
+    Подбирает самый крупный шрифт (из сетки MAX_FONT_SIZE..MIN_FONT_SIZE с шагом FONT_SIZE_STEP),
+    при котором текст помещается в область max_width x max_height. Бинарный поиск вместо перебора сверху вниз:
+    ~5 разбиений на строки вместо 23. Возвращает (font, lines, line_height).
+    """
+    sizes = list(range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1, FONT_SIZE_STEP))
+    layouts = {}
+
+    def layout(size):
+        # Разбиение на строки для каждого размера считаем не больше одного раза
+        if size not in layouts:
+            font = get_font(size)
+            lines = wrap_text(text, font, max_width, draw_obj)
+            total_height, line_height = get_text_block_size(lines, font, draw_obj)
+            layouts[size] = (font, lines, total_height, line_height)
+        return layouts[size]
+
     try:
-        canvas = Image.new('RGB', CANVAS_SIZE, BG_COLOR)
-        draw = ImageDraw.Draw(canvas)
-
-        # Картинка AI
-        ai_image = Image.open(ai_image_io)
-        if ai_image.mode != 'RGB': ai_image = ai_image.convert('RGB')
-        ai_image = ai_image.resize(IMAGE_SIZE, Image.LANCZOS)
-        canvas.paste(ai_image, (0, 0))
-
-        # Текст
-        if user_text:
-            current_font_size = MAX_FONT_SIZE
-            final_lines = []
-            final_font = None
-            final_line_height = 0
-            
-            # 1. Подбор размера
-            while current_font_size >= MIN_FONT_SIZE:
-                try:
-                    font = ImageFont.truetype(FONT_PATH, current_font_size)
-                except IOError:
-                    logging.critical(f"🚨 FONT ERROR: Could not find {FONT_PATH}!")
-                    font = ImageFont.load_default()
-                    final_lines = wrap_text(user_text, font, TEXT_MAX_WIDTH, draw)
-                    final_font = font
-                    break 
-                
-                lines = wrap_text(user_text, font, TEXT_MAX_WIDTH, draw)
-                total_height, line_height = get_text_block_size(lines, font, draw)
-                
-                if total_height <= TEXT_MAX_HEIGHT:
-                    final_lines = lines
-                    final_font = font
-                    final_line_height = line_height
-                    break 
-                
-                current_font_size -= 5
-            
-            # Fallback
-            if final_font is None:
-                 try:
-                    final_font = ImageFont.truetype(FONT_PATH, MIN_FONT_SIZE)
-                 except:
-                    final_font = ImageFont.load_default()
-                 final_lines = wrap_text(user_text, final_font, TEXT_MAX_WIDTH, draw)
-                 _, final_line_height = get_text_block_size(final_lines, final_font, draw)
-
-            # 2. Рисование по центру
-            block_height = len(final_lines) * final_line_height
-            start_y = TEXT_START_Y + (TEXT_MAX_HEIGHT - block_height) / 2
-            
-            for line in final_lines:
-                bbox = draw.textbbox((0, 0), line, font=final_font)
-                text_width = bbox[2] - bbox[0]
-                x = (CANVAS_SIZE[0] - text_width) / 2
-                
-                # ИСПОЛЬЗУЕМ ЦВЕТ ТЕКСТА
-                draw.text((x, start_y), line, font=final_font, fill=TEXT_COLOR)
-                start_y += final_line_height
-
-        # Рамка: ИСПОЛЬЗУЕМ ЦВЕТ РАМКИ
-        draw.rectangle(
-            [(0, 0), (CANVAS_SIZE[0]-1, CANVAS_SIZE[1]-1)], 
-            outline=FRAME_COLOR, 
-            width=FRAME_WIDTH
+        best = None
+        lo, hi = 0, len(sizes) - 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if layout(sizes[mid])[2] <= max_height:
+                best = sizes[mid]
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        # Fallback: даже минимальный размер не влез - используем его
+        font, lines, _, line_height = layout(best if best is not None else MIN_FONT_SIZE)
+        return font, lines, line_height
+    except IOError:
+        logging.critical(f"🚨 FONT ERROR: Could not find {FONT_PATH}!")
+        font = ImageFont.load_default()
+        lines = wrap_text(text, font, max_width, draw_obj)
+        _, line_height = get_text_block_size(lines, font, draw_obj)
+        return font, lines, line_height
+
+# --- СЖАТИЕ ---
+
+# Последнее подошедшее качество JPEG по теме - с него начинается поиск для следующей открытки
+_quality_estimates = {}
+
+def encode_to_size(image, max_bytes: int = JPEG_MAX_BYTES, quality_hint: int = None, image_format: str = 'JPEG', **save_options):
+    """
+    Кодирует картинку (JPEG, WEBP) с максимальным качеством из сетки, при котором файл
+    не превышает max_bytes. Поиск начинается с quality_hint (соседнее качество проверяется
+    для подтверждения), дальше - бинарный поиск по сетке.
+    Возвращает (bytes, quality, число кодирований).
+    """
+    grid = list(range(JPEG_QUALITY_MIN, JPEG_QUALITY_MAX + 1, JPEG_QUALITY_STEP))
+    encoded = {}
+
+    def fits(index):
+        if index not in encoded:
+            buffer = BytesIO()
+            image.save(buffer, format=image_format, quality=grid[index], **save_options)
+            encoded[index] = buffer.getvalue()
+        return len(encoded[index]) <= max_bytes
+
+    # lo - самый высокий индекс, который точно влезает, hi - самый низкий, который точно не влезает
+    lo, hi = -1, len(grid)
+    start = len(grid) - 1
+    if quality_hint is not None:
+        start = min(range(len(grid)), key=lambda i: abs(grid[i] - quality_hint))
+
+    if fits(start):
+        lo = start
+        if start + 1 < hi:
+            if fits(start + 1):
+                lo = start + 1
+            else:
+                hi = start + 1
+    else:
+        hi = start
+        if start - 1 >= 0:
+            if fits(start - 1):
+                lo = start - 1
+            else:
+                hi = start - 1
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid
+
+    # Даже минимальное качество не влезло - отдаем его, как и раньше
+    index = max(lo, 0)
+    fits(index)
+    return encoded[index], grid[index], len(encoded)
+
+# --- КЭШ ТЕКСТОВЫХ БЛОКОВ ---
+# Текст открытки часто повторяется (шаблонный текст, "Happy New Year 2026!"), а подбор шрифта,
+# перенос и растеризация глифов - самая дорогая часть сборки после ресайза. Готовый блок
+# храним как RGBA-плитку цвета текста с альфой из глифов плюс позицию на холсте.
+
+# (нормализованный текст, шрифт, макет) -> (плитка RGBA, (x, y)) или None для пустого текста
+_text_tiles = OrderedDict()
+# При COMPOSE_WORKERS=0 открытки собираются в нескольких потоках одного процесса
+_text_tiles_lock = threading.Lock()
+
+def normalize_card_text(text: str) -> str:
+    """Текст так, как его видит перенос: слова через один пробел"""
+    return " ".join(text.split()) if text else ""
+
+def _render_text_tile(text: str, layout: CardLayout):
+    """Подбирает шрифт, переносит и растеризует текст в плитку по области текста макета"""
+    text_x, text_y, text_width_max, text_height_max = layout.text_box
+    draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    # 1. Подбор размера
+    final_font, final_lines, final_line_height = fit_text(text, draw, text_width_max, text_height_max)
+    if not final_lines:
+        return None
+
+    # 2. Позиции строк по центру области - те же, что при рисовании прямо на холсте
+    block_height = len(final_lines) * final_line_height
+    start_y = text_y + (text_height_max - block_height) / 2
+    placed = []
+    for line in final_lines:
+        text_width = measure_text_width(line, final_font, draw)
+        placed.append((text_x + (text_width_max - text_width) / 2, start_y, line))
+        start_y += final_line_height
+
+    # 3. Плитка по общим границам строк. Сдвиг целый и позиции в плитке неотрицательные,
+    # поэтому Pillow округляет их так же, как при рисовании прямо на холсте
+    boxes = [draw.textbbox((x, y), line, font=final_font) for x, y, line in placed]
+    left = math.floor(min(min(box[0], x) for box, (x, _, _) in zip(boxes, placed)))
+    top = math.floor(min(min(box[1], y) for box, (_, y, _) in zip(boxes, placed)))
+    right = math.ceil(max(box[2] for box in boxes)) + 1
+    bottom = math.ceil(max(box[3] for box in boxes)) + 1
+    mask = Image.new("L", (right - left, bottom - top), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    for x, y, line in placed:
+        mask_draw.text((x - left, y - top), line, font=final_font, fill=255)
+
+    tile = Image.new("RGBA", mask.size, layout.text_color + (0,))
+    tile.putalpha(mask)
+    return tile, (left, top)
+
+def get_text_tile(text: str, layout: CardLayout):
+    """Отрисованный текстовый блок из LRU-кэша: (плитка RGBA, (x, y)) или None"""
+    key = (normalize_card_text(text), FONT_PATH, layout)
+    with _text_tiles_lock:
+        if key in _text_tiles:
+            _text_tiles.move_to_end(key)
+            return _text_tiles[key]
+    tile = _render_text_tile(key[0], layout)
+    if TEXT_TILE_CACHE_SIZE > 0:
+        with _text_tiles_lock:
+            _text_tiles[key] = tile
+            while len(_text_tiles) > TEXT_TILE_CACHE_SIZE:
+                _text_tiles.popitem(last=False)
+    return tile
+
+def _render_card(image_file, user_text: str, layout_name: str = DEFAULT_CARD_LAYOUT):
+    """Собирает холст открытки: шаблон макета (фон + подложка + рамка) + AI картинка + текст."""
+    layout = CARD_LAYOUTS[layout_name]
+    template = get_template(layout)
+    canvas = template.new_canvas()
+
+    # Картинка AI (рамка поверх нее восстанавливается из шаблона)
+    ai_image = Image.open(image_file)
+    if ai_image.mode != 'RGB': ai_image = ai_image.convert('RGB')
+    ai_image = ai_image.resize(layout.image_box[2:], Image.LANCZOS)
+    template.paste_image(canvas, ai_image)
+
+    # Текст: готовая плитка из кэша накладывается одной операцией
+    text_tile = get_text_tile(user_text, layout) if user_text else None
+    if text_tile:
+        tile, position = text_tile
+        canvas.paste(tile, position, tile)
+        # Слишком длинный текст может заехать на рамку - рамка остается поверх
+        template.restore_frame(canvas, (*position, position[0] + tile.width, position[1] + tile.height))
+
+    return canvas
+
+def _shape_output(card, shape: str, size, layout: CardLayout):
+    if shape == "square":
+        return ImageOps.pad(card, size, method=Image.LANCZOS, color=layout.bg_color)
+    if shape == "thumbnail":
+        factor = card.width // size[0]
+        # Кратное уменьшение (1080x1920 -> 270x480) - быстрый reduce вместо ресайза
+        if factor > 1 and card.size == (size[0] * factor, size[1] * factor):
+            return card.reduce(factor)
+        return card.resize(size, Image.LANCZOS)
+    return card
+
+def _compose_card_sync(image_file, user_text: str, quality_hints: dict = None, layout_name: str = DEFAULT_CARD_LAYOUT,
+                       formats=DEFAULT_OUTPUT_FORMATS):
+    """
+    Синхронная сборка и сжатие открытки во всех нужных форматах за один проход:
+    AI картинка декодируется и открытка рисуется один раз, форматы одной формы
+    кодируются из общего изображения. Возвращает {формат: (bytes, quality, encodes)}.
+    """
+    layout = CARD_LAYOUTS[layout_name]
+    card = _render_card(image_file, user_text, layout_name)
+    quality_hints = quality_hints or {}
+    shaped = {}
+    outputs = {}
+    for name in formats:
+        spec = OUTPUT_FORMATS[name]
+        key = (spec.shape, spec.size)
+        if key not in shaped:
+            shaped[key] = _shape_output(card, spec.shape, spec.size, layout)
+        save_options = {"progressive": True} if spec.progressive else {}
+        outputs[name] = encode_to_size(
+            shaped[key], spec.max_bytes, quality_hints.get(name), spec.image_format, **save_options
+        )
+    return outputs
+
+# --- ПУЛ ПРОЦЕССОВ ДЛЯ СБОРКИ ---
+
+_compose_executor = None
+_compose_slots = asyncio.Semaphore(max(1, COMPOSE_MAX_PENDING))
+
+def _init_compose_worker(warm_texts=()):
+    """
+    Инициализация процесса-сборщика: шрифты, таблицы глифов и шаблоны грузятся один раз,
+    частые тексты (warm_texts) сразу отрисовываются для всех макетов.
+    """
+    # Ctrl+C обрабатывает основной процесс, воркеры просто завершаются вместе с пулом
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for layout in CARD_LAYOUTS.values():
+        get_template(layout)
+    for size in range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1, FONT_SIZE_STEP):
+        try:
+            get_glyph_metrics(get_font(size))
+        except IOError:
+            logging.critical(f"🚨 FONT ERROR: Could not find {FONT_PATH}!")
+            return
+    for text in warm_texts:
+        for layout in CARD_LAYOUTS.values():
+            get_text_tile(text, layout)
+
+def _attach_shared_memory(name: str):
+    shm = shared_memory.SharedMemory(name=name)
+    # До Python 3.13 подключение к сегменту тоже регистрирует его в resource_tracker,
+    # и тот удалил бы сегмент основного процесса при выходе воркера
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _compose_card_worker(shm_name: str, input_size: int, user_text: str, quality_hints: dict = None,
+                         layout_name: str = DEFAULT_CARD_LAYOUT, formats=DEFAULT_OUTPUT_FORMATS):
+    """
+    Выполняется в процессе-сборщике. Картинка читается из разделяемой памяти, готовые файлы
+    записываются туда же подряд. Возвращает {формат: ((offset, size), quality, encodes)};
+    если файл не влез в сегмент, вместо (offset, size) возвращаются сами байты.
+    """
+    shm = _attach_shared_memory(shm_name)
+    try:
+        image_file = BytesIO(shm.buf[:input_size])
+        outputs = _compose_card_sync(image_file, user_text, quality_hints, layout_name, formats)
+        # Входная картинка уже прочитана - ее место можно занимать
+        offset = 0
+        result = {}
+        for name, (data, quality, encodes) in outputs.items():
+            if offset + len(data) > shm.size:
+                result[name] = (data, quality, encodes)
+                continue
+            shm.buf[offset:offset + len(data)] = data
+            result[name] = ((offset, len(data)), quality, encodes)
+            offset += len(data)
+        return result
+    finally:
+        shm.close()
+
+_compose_warm_texts = ()
+
+def start_compose_pool(warm_texts=None):
+    """
+    Запускает процессы-сборщики заранее, до начала обработки апдейтов.
+    warm_texts - частые тексты открыток, которые каждый процесс отрисует заранее.
+    """
+    global _compose_executor, _compose_warm_texts
+    if warm_texts is not None:
+        _compose_warm_texts = tuple(warm_texts)
+    if COMPOSE_WORKERS <= 0 or _compose_executor:
+        return _compose_executor
+    _compose_executor = ProcessPoolExecutor(
+        max_workers=COMPOSE_WORKERS, initializer=_init_compose_worker, initargs=(_compose_warm_texts,)
+    )
+    # Первая задача поднимает все процессы сразу
+    _compose_executor.submit(int)
+    logging.info(f"🧩 Пул сборки открыток запущен: {COMPOSE_WORKERS} процесс(ов)")
+    return _compose_executor
+
+def shutdown_compose_pool(executor=None):
+    """
+    Останавливает процессы-сборщики. Если передан executor, пул останавливается, только
+    пока он текущий: упавший пул мог уже пересоздать другой вызов.
+    """
+    global _compose_executor
+    if not _compose_executor or (executor is not None and _compose_executor is not executor):
+        return
+    _compose_executor.shutdown(wait=False, cancel_futures=True)
+    _compose_executor = None
+
+def _release_shared_memory(shm):
+    shm.close()
+    shm.unlink()
+
+async def _compose_in_process(executor, ai_image_io: BytesIO, user_text: str, quality_hints: dict = None,
+                              layout_name: str = DEFAULT_CARD_LAYOUT, formats=DEFAULT_OUTPUT_FORMATS,
+                              on_done=None):
+    """
+    Передает картинку в процесс-сборщик через разделяемую память, без pickle.
+    on_done вызывается ровно один раз - когда процесс-сборщик больше не работает с памятью
+    (при отмене это может случиться позже, чем отмена дойдет до вызывающего).
+    """
+    def finished(future=None):
+        if shm:
+            _release_shared_memory(shm)
+        # Забираем исключение задачи, результат которой уже никому не нужен
+        if future is not None and not future.cancelled():
+            future.exception()
+        if on_done:
+            on_done()
+
+    shm = None
+    image_view = ai_image_io.getbuffer()
+    try:
+        input_size = image_view.nbytes
+        # Место под все выходные файлы; запас - на случай, если какой-то не удалось сжать до лимита
+        output_capacity = sum(OUTPUT_FORMATS[name].max_bytes for name in formats) + COMPOSE_OUTPUT_CAPACITY
+        shm = shared_memory.SharedMemory(create=True, size=max(input_size, output_capacity))
+        shm.buf[:input_size] = image_view
+        future = asyncio.get_running_loop().run_in_executor(
+            executor, _compose_card_worker, shm.name, input_size, user_text, quality_hints, layout_name, formats
         )
+    except BaseException:
+        finished()
+        raise
+    finally:
+        # Пока есть view, BytesIO нельзя ни менять, ни закрыть
+        image_view.release()
 
-        # Сжатие
-        output_io = BytesIO()
-        quality = 95
-        while quality > 10:
-            output_io.seek(0)
-            output_io.truncate()
-            canvas.save(output_io, format='JPEG', quality=quality)
-            if output_io.tell() / 1024 <= 300: break
-            quality -= 5
+    try:
+        result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Процесс-сборщик еще пишет в разделяемую память: освобождаем ее, когда он закончит
+        future.add_done_callback(finished)
+        raise
+    except BaseException:
+        finished()
+        raise
 
-        output_io.seek(0)
-        return output_io
+    try:
+        outputs = {}
+        for name, (location, quality, encodes) in result.items():
+            if isinstance(location, bytes):
+                outputs[name] = (location, quality, encodes)
+            else:
+                offset, size = location
+                outputs[name] = (bytes(shm.buf[offset:offset + size]), quality, encodes)
+        return outputs
+    finally:
+        finished()
 
+async def _compose(ai_image_io: BytesIO, user_text: str, quality_hints: dict = None, layout_name: str = DEFAULT_CARD_LAYOUT,
+                   formats=DEFAULT_OUTPUT_FORMATS):
+    # Ограничиваем число открыток в работе: лишние ждут здесь, а не в очереди пула.
+    # Слот процесса-сборщика возвращает _compose_in_process, когда сборка действительно закончилась
+    await _compose_slots.acquire()
+    try:
+        executor = start_compose_pool()
+    except BaseException:
+        _compose_slots.release()
+        raise
+    if not executor:
+        try:
+            return await asyncio.to_thread(_compose_card_sync, ai_image_io, user_text, quality_hints, layout_name, formats)
+        finally:
+            _compose_slots.release()
+    try:
+        return await _compose_in_process(
+            executor, ai_image_io, user_text, quality_hints, layout_name, formats, on_done=_compose_slots.release
+        )
+    except BrokenProcessPool:
+        logging.error("Пул сборки открыток упал, пересоздаю")
+        shutdown_compose_pool(executor)
+    await _compose_slots.acquire()
+    try:
+        executor = start_compose_pool()
+    except BaseException:
+        _compose_slots.release()
+        raise
+    return await _compose_in_process(
+        executor, ai_image_io, user_text, quality_hints, layout_name, formats, on_done=_compose_slots.release
+    )
+
+async def compose_card_outputs(ai_image_io: BytesIO, user_text: str, topic_code: str = None, deadline=None,
+                               layout_name: str = None, formats=DEFAULT_OUTPUT_FORMATS) -> dict:
+    """
+    Собирает открытку в макете layout_name (по умолчанию CARD_LAYOUT) сразу в нескольких
+    форматах из OUTPUT_FORMATS. Возвращает {формат: BytesIO} или None при ошибке.
+    Бросает DeadlineExceeded, если сборка не укладывается в дедлайн.
+    """
+    if deadline:
+        deadline.ensure(MIN_COMPOSE_TIME, "card composition")
+    try:
+        if layout_name not in CARD_LAYOUTS:
+            layout_name = DEFAULT_CARD_LAYOUT
+        formats = tuple(name for name in formats if name in OUTPUT_FORMATS) or DEFAULT_OUTPUT_FORMATS
+        # Размер файла зависит от темы, макета и формата
+        quality_hints = {name: _quality_estimates.get((topic_code, layout_name, name)) for name in formats}
+        outputs = await asyncio.wait_for(
+            _compose(ai_image_io, user_text, quality_hints, layout_name, formats),
+            timeout=deadline.remaining() if deadline else None
+        )
+
+        result = {}
+        for name, (data, quality, encodes) in outputs.items():
+            if topic_code:
+                _quality_estimates[(topic_code, layout_name, name)] = quality
+            logging.info(
+                f"🗜️ {name} ({OUTPUT_FORMATS[name].image_format}): quality={quality}, "
+                f"{len(data) // 1024} KB, {encodes} encode(s)"
+            )
+            result[name] = BytesIO(data)
+        return result
+
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("deadline expired during card composition")
     except Exception as e:
         logging.error(f"Composition Error: {e}")
         return None
+
+async def compose_final_card(ai_image_io: BytesIO, user_text: str, topic_code: str = None, deadline=None,
+                             layout_name: str = None) -> BytesIO:
+    """
+    Собирает открытку для Telegram (формат story). Возвращает BytesIO с JPEG или None при ошибке.
+    Бросает DeadlineExceeded, если сборка не укладывается в дедлайн.
+    """
+    outputs = await compose_card_outputs(ai_image_io, user_text, topic_code, deadline, layout_name, ("story",))
+    return outputs["story"] if outputs else None
@@ -0,0 +1,187 @@
+"""
+Пул заранее сгенерированных AI-фонов для каждой пары (страна, тема).
+
+Фон открытки зависит только от страны и темы, поэтому его можно
+сгенерировать заранее: пул держит несколько готовых картинок на каждую
+пару из text_content.get_available_topics, асинхронно пополняет их,
+когда запас заканчивается, и выбрасывает устаревшие.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from io import BytesIO
+
+import text_content as tc
+
+# --- КОНФИГУРАЦИЯ ---
+# Сколько готовых фонов держать на каждую пару (страна, тема). 0 - пул выключен
+POOL_SIZE = int(os.getenv("BACKGROUND_POOL_SIZE", "2"))
+# Пополняем пару, когда в ней осталось столько фонов или меньше
+POOL_LOW_WATERMARK = int(os.getenv("BACKGROUND_POOL_LOW_WATERMARK", "1"))
+# Сколько секунд фон считается свежим
+POOL_TTL = int(os.getenv("BACKGROUND_POOL_TTL", str(6 * 60 * 60)))
+# Сколько генераций пул может выполнять одновременно
+POOL_REFILL_CONCURRENCY = int(os.getenv("BACKGROUND_POOL_CONCURRENCY", "2"))
+# Как часто проверять пул на устаревшие фоны (секунды)
+POOL_EVICT_INTERVAL = 10 * 60
+# Сколько уже выданных или устаревших фонов хранить на пару про запас - на случай, если Gemini недоступен
+POOL_FALLBACK_SIZE = int(os.getenv("BACKGROUND_POOL_FALLBACK_SIZE", "1"))
+
+
+class BackgroundPool:
+    """Хранит готовые фоны по ключу (country, topic) и пополняет их в фоне."""
+
+    def __init__(self, generator, size: int = POOL_SIZE, low_watermark: int = POOL_LOW_WATERMARK,
+                 ttl: int = POOL_TTL, concurrency: int = POOL_REFILL_CONCURRENCY):
+        # generator: async функция (prompt, variant) -> BytesIO | None (ai_service.generate_image_bytes)
+        self._generator = generator
+        self.size = size
+        self.low_watermark = min(low_watermark, size)
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        # (country, topic) -> deque[(created_at, image_bytes)]
+        self._items = {key: deque() for key in self.pool_keys()}
+        # (country, topic) -> deque[image_bytes]: выданные или устаревшие фоны для аварийного режима
+        self._fallback = {key: deque(maxlen=POOL_FALLBACK_SIZE) for key in self._items}
+        self._refill_tasks = {}
+        self._evict_task = None
+
+    @staticmethod
+    def pool_keys():
+        """Все допустимые пары (страна, тема)"""
+        return [
+            (country, topic)
+            for country in tc.COUNTRIES
+            for topic in tc.get_available_topics(country)
+        ]
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self):
+        """Запускает первоначальное наполнение и периодическую очистку"""
+        if not self.enabled:
+            logging.info("Пул фонов отключен (BACKGROUND_POOL_SIZE=0)")
+            return
+        for key in self._items:
+            self._schedule_refill(key)
+        self._evict_task = asyncio.create_task(self._evict_loop())
+        logging.info(f"🖼️ Пул фонов запущен: {len(self._items)} пар по {self.size} фонов")
+
+    async def stop(self):
+        """Останавливает пополнение и очистку"""
+        tasks = list(self._refill_tasks.values())
+        if self._evict_task:
+            tasks.append(self._evict_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._refill_tasks.clear()
+        self._evict_task = None
+
+    def take(self, country_code: str, topic_code: str):
+        """Забирает готовый фон из пула. Возвращает BytesIO или None, если пул пуст."""
+        key = (country_code, topic_code)
+        items = self._items.get(key)
+        if items is None or not self.enabled:
+            return None
+
+        self._evict_stale(key)
+        image_bytes = items.popleft()[1] if items else None
+        if image_bytes and POOL_FALLBACK_SIZE > 0:
+            self._fallback[key].append(image_bytes)
+
+        if len(items) <= self.low_watermark:
+            self._schedule_refill(key)
+        return BytesIO(image_bytes) if image_bytes else None
+
+    def take_fallback(self, country_code: str, topic_code: str):
+        """
+        Аварийный фон, когда Gemini недоступен: свежий из пула, а если его нет -
+        один из уже выданных или устаревших. Возвращает BytesIO или None.
+        """
+        image_io = self.take(country_code, topic_code)
+        if image_io:
+            return image_io
+        fallback = self._fallback.get((country_code, topic_code))
+        return BytesIO(fallback[-1]) if fallback else None
+
+    def put(self, country_code: str, topic_code: str, image_bytes: bytes, created_at: float = None) -> bool:
+        """Возвращает неиспользованный фон в пул, если в нем есть место"""
+        items = self._items.get((country_code, topic_code))
+        if items is None or not self.enabled or len(items) >= self.size or not image_bytes:
+            return False
+        items.append((time.monotonic() if created_at is None else created_at, image_bytes))
+        return True
+
+    async def warm(self, loader):
+        """
+        Наполняет пул сохраненными фонами до start(), чтобы после перезапуска не генерировать все заново.
+        loader: async функция (prompts, limit) -> [(image_bytes, возраст в секундах)] - не больше limit
+        самых свежих фонов по всем промптам (ai_service.cached_backgrounds).
+        Устаревшие фоны уходят в запас для аварийного режима.
+        """
+        if not self.enabled:
+            return
+        warmed = 0
+        now = time.monotonic()
+        for key, items in self._items.items():
+            needed = self.size - len(items)
+            if needed <= 0:
+                continue
+            try:
+                images = await loader(tc.build_variant_prompts(*key), needed)
+            except Exception as e:
+                logging.error(f"Пул фонов: не удалось прочитать сохраненные фоны для {key}: {e}")
+                continue
+            # В очереди фоны должны идти от старых к свежим
+            for image_bytes, age in reversed(images):
+                if self.put(*key, image_bytes, created_at=now - age):
+                    warmed += 1
+            self._evict_stale(key)
+        logging.info(f"🖼️ Пул фонов: {warmed} фонов загружено из кэша")
+
+    def _evict_stale(self, key):
+        items = self._items[key]
+        cutoff = time.monotonic() - self.ttl
+        while items and items[0][0] < cutoff:
+            if POOL_FALLBACK_SIZE > 0:
+                self._fallback[key].append(items.popleft()[1])
+            else:
+                items.popleft()
+
+    def _schedule_refill(self, key):
+        task = self._refill_tasks.get(key)
+        if task and not task.done():
+            return
+        self._refill_tasks[key] = asyncio.create_task(self._refill(key))
+
+    async def _refill(self, key):
+        country_code, topic_code = key
+        items = self._items[key]
+        try:
+            while len(items) < self.size:
+                # Каждый фон - случайный вариант промпта, чтобы пул не состоял из похожих картинок
+                prompt, variant = tc.build_final_prompt(country_code, topic_code)
+                async with self._semaphore:
+                    image_io = await self._generator(prompt, variant)
+                if not image_io:
+                    # Не долбим API в цикле: следующая попытка будет при следующем take() или очистке
+                    logging.warning(f"Пул фонов: не удалось сгенерировать фон для {key}")
+                    return
+                items.append((time.monotonic(), image_io.getvalue()))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Пул фонов: ошибка пополнения {key}: {e}")
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(POOL_EVICT_INTERVAL)
+            for key, items in self._items.items():
+                self._evict_stale(key)
+                if len(items) <= self.low_watermark:
+                    self._schedule_refill(key)
@@ -5,10 +5,13 @@ import json
 import os
 import sys
 import random
-import csv
-import io
+import bisect
+from array import array
+from datetime import datetime, timedelta
 from pathlib import Path
+from types import MappingProxyType
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -23,6 +26,12 @@ from aiogram.types import (
 import config
 import text_content as tc
 import ai_service
+import stats
+import user_export
+from background_pool import BackgroundPool
+from generation_scheduler import GenerationScheduler, QueueFull
+from broadcast import Broadcast
+from deadline import Deadline, DeadlineExceeded
 
 # #region agent log
 # Debug logging (опционально, только для локальной разработки)
@@ -62,6 +71,22 @@ logging.basicConfig(
 bot = Bot(token=config.BOT_TOKEN)
 dp = Dispatcher()
 
+# Единая очередь генераций перед Gemini: ограничение параллельности и честная очередность
+generation_scheduler = GenerationScheduler(ai_service.generate_image_bytes)
+
+# Пул наполняется через ту же очередь, отдельной "полосой" - пользователи не ждут его целиком
+POOL_LANE = "background_pool"
+
+async def generate_for_pool(prompt: str, variant=None):
+    try:
+        return await generation_scheduler.submit(POOL_LANE, prompt, variant=variant)
+    except (QueueFull, ai_service.CircuitOpenError):
+        # При перегрузке или сбое Gemini пул подождет - живые пользователи важнее
+        return None
+
+# Пул готовых AI-фонов по парам (страна, тема)
+background_pool = BackgroundPool(generate_for_pool)
+
 # --- DATABASE ---
 # Connection pool для PostgreSQL
 db_pool: asyncpg.Pool = None
@@ -87,6 +112,8 @@ async def init_db():
                     joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # Индекс по joined_at и дневная сводка для админской статистики
+            await stats.ensure_schema(conn)
         
         logging.info("✅ База данных PostgreSQL инициализирована")
     except Exception as e:
@@ -100,35 +127,6 @@ async def close_db():
         await db_pool.close()
         logging.info("База данных закрыта")
 
-async def add_user(user_id: int, username: str):
-    """Добавление пользователя в базу данных"""
-    if not db_pool:
-        logging.error("Connection pool не инициализирован")
-        return
-    
-    try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO users (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
-                user_id, username or None
-            )
-    except Exception as e:
-        logging.error(f"Ошибка при добавлении пользователя: {e}")
-
-async def get_all_users():
-    """Получение списка всех пользователей"""
-    if not db_pool:
-        logging.error("Connection pool не инициализирован")
-        return []
-    
-    try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT user_id FROM users")
-            return [row['user_id'] for row in rows]
-    except Exception as e:
-        logging.error(f"Ошибка при получении списка пользователей: {e}")
-        return []
-
 async def get_user_info(user_id: int):
     """Получение информации о конкретном пользователе"""
     if not db_pool:
@@ -146,53 +144,48 @@ async def get_user_info(user_id: int):
         logging.error(f"Ошибка при получении информации о пользователе: {e}")
         return None
 
-async def get_users_list(limit: int = 50, offset: int = 0):
-    """Получение списка пользователей с пагинацией"""
-    if not db_pool:
-        logging.error("Connection pool не инициализирован")
-        return []
-    
-    try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT user_id, username, joined_at FROM users ORDER BY joined_at DESC LIMIT $1 OFFSET $2",
-                limit, offset
-            )
-            return [dict(row) for row in rows]
-    except Exception as e:
-        logging.error(f"Ошибка при получении списка пользователей: {e}")
-        return []
-
-async def get_users_count():
-    """Получение общего количества пользователей"""
+async def get_users_page(limit: int = 20, cursor: tuple = None, newer: bool = False):
+    """
+    Страница пользователей от новых к старым с keyset-пагинацией по (joined_at, user_id).
+    cursor - (joined_at, user_id) крайней записи соседней страницы: без newer берутся записи
+    старше курсора, с newer - новее. Возвращает (список, есть ли еще записи в этом направлении).
+    Каждая страница - один проход по индексу, сколько бы страниц ни было до нее.
+    """
     if not db_pool:
         logging.error("Connection pool не инициализирован")
-        return 0
+        return [], False
     
-    try:
-        async with db_pool.acquire() as conn:
-            count = await conn.fetchval("SELECT COUNT(*) FROM users")
-            return count or 0
-    except Exception as e:
-        logging.error(f"Ошибка при получении количества пользователей: {e}")
-        return 0
-
-async def get_recent_users(days: int = 7):
-    """Получение количества новых пользователей за последние N дней"""
-    if not db_pool:
-        logging.error("Connection pool не инициализирован")
-        return 0
+    if cursor is None:
+        # Записи без даты регистрации в курсор не попадают (сравнение с NULL), поэтому не показываем их и здесь
+        query = (
+            "SELECT user_id, username, joined_at FROM users WHERE joined_at IS NOT NULL "
+            "ORDER BY joined_at DESC, user_id DESC LIMIT $1"
+        )
+        args = ()
+    elif newer:
+        query = (
+            "SELECT user_id, username, joined_at FROM users WHERE (joined_at, user_id) > ($2, $3) "
+            "ORDER BY joined_at ASC, user_id ASC LIMIT $1"
+        )
+        args = cursor
+    else:
+        query = (
+            "SELECT user_id, username, joined_at FROM users WHERE (joined_at, user_id) < ($2, $3) "
+            "ORDER BY joined_at DESC, user_id DESC LIMIT $1"
+        )
+        args = cursor
     
     try:
         async with db_pool.acquire() as conn:
-            count = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE joined_at >= NOW() - make_interval(days => $1)",
-                days
-            )
-            return count or 0
+            # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+            rows = await conn.fetch(query, limit + 1, *args)
+        users = [dict(row) for row in rows[:limit]]
+        if newer:
+            users.reverse()
+        return users, len(rows) > limit
     except Exception as e:
-        logging.error(f"Ошибка при получении новых пользователей: {e}")
-        return 0
+        logging.error(f"Ошибка при получении списка пользователей: {e}")
+        return [], False
 
 async def delete_user(user_id: int):
     """Удаление пользователя из базы данных"""
@@ -200,17 +193,141 @@ async def delete_user(user_id: int):
         logging.error("Connection pool не инициализирован")
         return False
     
+    # Пользователь мог еще не дойти до базы - убираем его и из буфера регистрации
+    was_pending = await user_registry.forget(user_id)
     try:
         async with db_pool.acquire() as conn:
             result = await conn.execute(
                 "DELETE FROM users WHERE user_id = $1",
                 user_id
             )
-            return result == "DELETE 1"
+            user_stats.invalidate()
+            return result == "DELETE 1" or was_pending
     except Exception as e:
         logging.error(f"Ошибка при удалении пользователя: {e}")
         return False
 
+# --- РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЕЙ (write-behind) ---
+# Как часто сбрасывать новых пользователей в базу (секунды)
+USER_FLUSH_INTERVAL = 5
+# Сбрасывать раньше, если накопилось столько новых пользователей
+USER_FLUSH_BATCH = 500
+
+class UserRegistry:
+    """
+    Множество известных user_id в памяти: /start не ходит в базу для тех, кто уже есть.
+    Новые пользователи копятся в буфере и пачкой записываются через executemany.
+    Загруженные при старте id хранятся компактно - отсортированным array('q') (8 байт на id),
+    добавленные после старта - в обычном set.
+    """
+
+    def __init__(self):
+        self._loaded = array('q')
+        self._added = set()
+        # user_id -> username пользователей, которых еще нет в базе
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self._added:
+            return True
+        index = bisect.bisect_left(self._loaded, user_id)
+        return index < len(self._loaded) and self._loaded[index] == user_id
+
+    def __len__(self) -> int:
+        return len(self._loaded) + len(self._added)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def load(self):
+        """Загружает id всех пользователей из базы (по возрастанию, потоком через курсор)"""
+        loaded = array('q')
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor("SELECT user_id FROM users ORDER BY user_id", prefetch=10000):
+                    loaded.append(row[0])
+        self._loaded = loaded
+        logging.info(f"👥 Загружено {len(loaded)} пользователей в память ({loaded.itemsize * len(loaded) // 1024} КБ)")
+
+    def register(self, user_id: int, username: str) -> bool:
+        """Запоминает пользователя. Возвращает True, если он новый (запись в базу - в фоне)."""
+        if user_id in self:
+            return False
+        self._added.add(user_id)
+        self._pending[user_id] = username or None
+        if len(self._pending) >= USER_FLUSH_BATCH:
+            self._wakeup.set()
+        return True
+
+    async def forget(self, user_id: int) -> bool:
+        """Убирает пользователя из памяти (при удалении). Возвращает True, если он еще не был записан."""
+        # Под замком сброса: пачка, которая уже пишется, успеет записаться до DELETE,
+        # а следующая не вставит удаленного пользователя заново
+        async with self._flush_lock:
+            return self._forget(user_id)
+
+    def _forget(self, user_id: int) -> bool:
+        self._added.discard(user_id)
+        index = bisect.bisect_left(self._loaded, user_id)
+        if index < len(self._loaded) and self._loaded[index] == user_id:
+            del self._loaded[index]
+        if user_id in self._pending:
+            del self._pending[user_id]
+            return True
+        return False
+
+    async def flush(self):
+        """Записывает накопленных новых пользователей одной пачкой"""
+        async with self._flush_lock:
+            if not self._pending or not db_pool:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                async with db_pool.acquire() as conn:
+                    await conn.executemany(
+                        "INSERT INTO users (user_id, username) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
+                        list(batch.items())
+                    )
+            except Exception as e:
+                logging.error(f"Ошибка при записи новых пользователей ({len(batch)}): {e}")
+                # Не теряем пользователей: вернутся в буфер и запишутся при следующем сбросе
+                for user_id, username in batch.items():
+                    if user_id in self._added:
+                        self._pending.setdefault(user_id, username)
+                return
+            logging.info(f"👥 Записано новых пользователей: {len(batch)}")
+
+    def start(self):
+        """Запускает периодический сброс буфера"""
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает сброс и записывает остаток буфера"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+user_registry = UserRegistry()
+
+# Админская статистика: один запрос и короткий кэш
+user_stats = stats.UserStatistics()
+
 # --- FSM STATES ---
 class CardGen(StatesGroup):
     choosing_country = State()
@@ -232,7 +349,7 @@ def make_inline_kb(items: dict, prefix: str, cols=2, add_cancel=False):
         builder.append([InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")])
     return InlineKeyboardMarkup(inline_keyboard=builder)
 
-def make_topics_kb(filtered_topics: dict, country_code: str):
+def make_topics_kb(filtered_topics, country_code: str):
     """Создает клавиатуру с темами и кнопкой 'Мне повезет' по 2 в ряд"""
     builder = []
     keys = list(filtered_topics.keys())
@@ -259,6 +376,102 @@ def make_topics_kb(filtered_topics: dict, country_code: str):
     
     return InlineKeyboardMarkup(inline_keyboard=builder)
 
+# --- KEYBOARD REGISTRY ---
+# Клавиатуры зависят только от каталога стран и тем, поэтому собираются один раз при старте.
+# Типы aiogram - неизменяемые (frozen) pydantic-модели, так что один экземпляр можно отдавать всем.
+START_KB = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🚀 Начать создание", callback_data="start_flow")]])
+COUNTRIES_KB = make_inline_kb(tc.COUNTRIES, prefix="country", add_cancel=True)
+TOPICS_KBS = MappingProxyType({
+    country_code: make_topics_kb(tc.get_country_topics(country_code), country_code)
+    for country_code in tc.COUNTRIES
+})
+CONFIRM_TOPIC_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Продолжить", callback_data="ask_for_text")],
+    [InlineKeyboardButton(text="⬅️ Назад к темам", callback_data="back_to_topics")],
+    [InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")]
+])
+SKIP_TEXT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📝 Использовать шаблон текста", callback_data="skip_text")],
+    [InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")]
+])
+# Кнопка "Создать еще одну" под готовой открыткой - возврат к выбору темы для той же страны
+RESTART_KBS = MappingProxyType({
+    country_code: InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Создать еще одну", callback_data=f"create_another:{country_code}")]
+    ])
+    for country_code in tc.COUNTRIES
+})
+
+def get_topics_kb(country_code: str) -> InlineKeyboardMarkup:
+    """Клавиатура тем страны с кнопкой 'Мне повезет' по 2 в ряд"""
+    return TOPICS_KBS.get(country_code) or make_topics_kb(tc.get_country_topics(country_code), country_code)
+
+# --- СПЕКУЛЯТИВНАЯ ГЕНЕРАЦИЯ ФОНА ---
+# Фон зависит только от страны и темы, поэтому генерацию запускаем сразу после
+# подтверждения темы - пока пользователь пишет текст. Задачи привязаны к FSM-сессии
+# пользователя: StorageKey -> ((country, topic), asyncio.Task)
+speculative_tasks = {}
+
+# Сколько секунд хранить готовый, но не востребованный фон
+SPECULATIVE_RESULT_TTL = 30 * 60
+
+async def generate_background(user_id: int, country_code: str, topic_code: str):
+    """Берет фон из пула или ставит генерацию в общую очередь"""
+    image_io = background_pool.take(country_code, topic_code)
+    if image_io:
+        return image_io
+    prompt, prompt_variant = tc.build_final_prompt(country_code, topic_code)
+    return await generation_scheduler.submit(user_id, prompt, variant=prompt_variant)
+
+def _release_speculative_result(params, task: asyncio.Task):
+    """Возвращает результат невостребованной задачи в пул фонов"""
+    if task.done() and not task.cancelled() and not task.exception():
+        image_io = task.result()
+        if image_io:
+            background_pool.put(*params, image_io.getvalue())
+
+def _expire_speculative_task(key, task: asyncio.Task):
+    entry = speculative_tasks.get(key)
+    if entry and entry[1] is task:
+        del speculative_tasks[key]
+        _release_speculative_result(entry[0], task)
+
+def start_speculative_generation(state: FSMContext, country_code: str, topic_code: str):
+    """Запускает генерацию фона в фоне, пока пользователь вводит текст"""
+    params = (country_code, topic_code)
+    entry = speculative_tasks.get(state.key)
+    if entry and entry[0] == params and not entry[1].cancelled():
+        return
+    cancel_speculative_generation(state)
+
+    key = state.key
+    task = asyncio.create_task(generate_background(key.user_id, country_code, topic_code))
+    # Если пользователь так и не дошел до генерации, не держим картинку в памяти вечно
+    task.add_done_callback(
+        lambda t: asyncio.get_running_loop().call_later(SPECULATIVE_RESULT_TTL, _expire_speculative_task, key, t)
+    )
+    speculative_tasks[key] = (params, task)
+
+def cancel_speculative_generation(state: FSMContext):
+    """Отменяет спекулятивную генерацию пользователя (cancel, back_to_topics, /start)"""
+    entry = speculative_tasks.pop(state.key, None)
+    if not entry:
+        return
+    params, task = entry
+    if task.done():
+        _release_speculative_result(params, task)
+    else:
+        task.cancel()
+
+def pop_speculative_generation(state: FSMContext, country_code: str, topic_code: str):
+    """Забирает задачу генерации, если она была запущена для тех же страны и темы"""
+    entry = speculative_tasks.get(state.key)
+    if not entry or entry[0] != (country_code, topic_code):
+        cancel_speculative_generation(state)
+        return None
+    del speculative_tasks[state.key]
+    return entry[1]
+
 # --- HANDLERS: START & FLOW ---
 
 @dp.message(CommandStart())
@@ -266,15 +479,16 @@ async def cmd_start(message: types.Message, state: FSMContext):
     # #region agent log
     debug_log("bot.py:93", "cmd_start ENTRY", {"user_id": message.from_user.id}, None)
     # #endregion
+    cancel_speculative_generation(state)
     await state.clear()
-    await add_user(message.from_user.id, message.from_user.username)
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🚀 Начать создание", callback_data="start_flow")]])
-    await message.answer("Приветствуем! Нажмите кнопку ниже, чтобы начать создание поздравительной открытки, учитывающей культурные особенности разных стран!", reply_markup=kb)
+    # Новый пользователь запишется в базу в фоне, /start не ждет Postgres
+    user_registry.register(message.from_user.id, message.from_user.username)
+    await message.answer("Приветствуем! Нажмите кнопку ниже, чтобы начать создание поздравительной открытки, учитывающей культурные особенности разных стран!", reply_markup=START_KB)
 
 @dp.callback_query(F.data == "start_flow")
 async def start_flow(callback: CallbackQuery, state: FSMContext):
     await state.set_state(CardGen.choosing_country)
-    await callback.message.edit_text("Из какой страны получатель вашей открытки?", reply_markup=make_inline_kb(tc.COUNTRIES, prefix="country", add_cancel=True))
+    await callback.message.edit_text("Из какой страны получатель вашей открытки?", reply_markup=COUNTRIES_KB)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("country:"))
@@ -292,7 +506,6 @@ async def country_chosen(callback: CallbackQuery, state: FSMContext):
     debug_log("bot.py:93", "get_available_topics RESULT", {"country": country_code, "available_topics": avail_topics_keys}, "A")
     # #endregion
     
-    filtered_topics = {k: tc.TOPICS[k] for k in avail_topics_keys}
     
     # #region agent log
     state_data = await state.get_data()
@@ -304,7 +517,7 @@ async def country_chosen(callback: CallbackQuery, state: FSMContext):
     await state.set_state(CardGen.choosing_topic)
     
     # Создаем клавиатуру с темами и кнопкой "Мне повезет" по 2 в ряд
-    kb = make_topics_kb(filtered_topics, country_code)
+    kb = get_topics_kb(country_code)
     
     await callback.message.edit_text(f"**Выбор страны: {tc.COUNTRIES[country_code]}**\n\n{tip_text}\n\n👇 Выберите тему:", reply_markup=kb, parse_mode="Markdown")
     await callback.answer()
@@ -333,6 +546,7 @@ async def lucky_topic_chosen(callback: CallbackQuery, state: FSMContext):
         # Сохраняем в state: topic="lucky" для отображения, lucky_topic для генерации
         await state.update_data(country=country_code, topic="lucky", lucky_topic=random_topic)
         await state.set_state(CardGen.waiting_for_text)
+        start_speculative_generation(state, country_code, random_topic)
         
         # Показываем предпросмотр параметров
         topic_display = "Бот выберет тему случайным образом, вам точно повезет!"
@@ -346,12 +560,7 @@ async def lucky_topic_chosen(callback: CallbackQuery, state: FSMContext):
             f"Или выберите \"Использовать шаблон\" и бот сам подберет текст для вас!"
         )
         
-        skip_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📝 Использовать шаблон текста", callback_data="skip_text")],
-            [InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")]
-        ])
-        
-        await callback.message.edit_text(preview_text, reply_markup=skip_kb, parse_mode="Markdown")
+        await callback.message.edit_text(preview_text, reply_markup=SKIP_TEXT_KB, parse_mode="Markdown")
         await callback.answer("🍀 Тема выбрана случайным образом!")
     except Exception as e:
         logging.error(f"Ошибка в lucky_topic_chosen: {e}")
@@ -383,10 +592,10 @@ async def topic_chosen(callback: CallbackQuery, state: FSMContext):
     # ВАЛИДАЦИЯ: Проверяем, что тема доступна для выбранной страны (гипотеза A)
     avail_topics = tc.get_available_topics(country_code)
     # #region agent log
-    debug_log("bot.py:152", "topic_chosen VALIDATION CHECK", {"country": country_code, "selected_topic": topic_code, "available_topics": avail_topics, "is_valid": topic_code in avail_topics}, "A")
+    debug_log("bot.py:152", "topic_chosen VALIDATION CHECK", {"country": country_code, "selected_topic": topic_code, "available_topics": avail_topics, "is_valid": tc.is_topic_available(country_code, topic_code)}, "A")
     # #endregion
     
-    if topic_code not in avail_topics:
+    if not tc.is_topic_available(country_code, topic_code):
         # #region agent log
         debug_log("bot.py:156", "topic_chosen VALIDATION FAILED", {"country": country_code, "invalid_topic": topic_code, "available_topics": avail_topics}, "A")
         # #endregion
@@ -403,11 +612,7 @@ async def topic_chosen(callback: CallbackQuery, state: FSMContext):
     desc = tc.TOPICS[topic_code]["desc"]
     topic_name = tc.TOPICS[topic_code]["btn"]
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Продолжить", callback_data="ask_for_text")],
-        [InlineKeyboardButton(text="⬅️ Назад к темам", callback_data="back_to_topics")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")]
-    ])
+    kb = CONFIRM_TOPIC_KB
     await state.set_state(CardGen.confirming_topic)
     await callback.message.edit_text(f"**Выбрана тема:** {topic_name}\n\n{desc}\n\nПерейти к добавлению вашего персонального сообщения?", reply_markup=kb, parse_mode="Markdown")
     await callback.answer()
@@ -428,15 +633,14 @@ async def back_to_topics(callback: CallbackQuery, state: FSMContext):
         return
     
     # Очищаем topic при возврате к выбору тем (дополнительная защита)
+    cancel_speculative_generation(state)
     await state.update_data(topic=None)
     
-    avail_topics_keys = tc.get_available_topics(country_code)
-    filtered_topics = {k: tc.TOPICS[k] for k in avail_topics_keys}
     tip_text = tc.get_tips(country_code)
     await state.set_state(CardGen.choosing_topic)
     
     # Создаем клавиатуру с темами и кнопкой "Мне повезет" по 2 в ряд
-    kb = make_topics_kb(filtered_topics, country_code)
+    kb = get_topics_kb(country_code)
     
     await callback.message.edit_text(f"**Выбор страны: {tc.COUNTRIES[country_code]}**\n\n{tip_text}\n\n👇 Выберите тему:", reply_markup=kb, parse_mode="Markdown")
     await callback.answer()
@@ -471,7 +675,7 @@ async def ask_for_text_action(callback: CallbackQuery, state: FSMContext):
     else:
         # Финальная проверка соответствия темы и страны
         avail_topics = tc.get_available_topics(country_code)
-        if topic_code not in avail_topics:
+        if not tc.is_topic_available(country_code, topic_code):
             # #region agent log
             debug_log("bot.py:297", "ask_for_text VALIDATION FAILED", {"country": country_code, "invalid_topic": topic_code, "available_topics": avail_topics}, "B")
             # #endregion
@@ -496,19 +700,86 @@ async def ask_for_text_action(callback: CallbackQuery, state: FSMContext):
     
     await state.set_state(CardGen.waiting_for_text)
     
-    # Кнопки: Пропустить и В начало
-    skip_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📝 Использовать шаблон текста", callback_data="skip_text")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="cancel")]
-    ])
+    # Тема подтверждена - запускаем генерацию фона, пока пользователь пишет текст
+    generation_topic = data.get('lucky_topic') if is_lucky else topic_code
+    if generation_topic:
+        start_speculative_generation(state, country_code, generation_topic)
     
-    await callback.message.edit_text(preview_text, reply_markup=skip_kb, parse_mode="Markdown")
+    # Кнопки: Пропустить и В начало
+    await callback.message.edit_text(preview_text, reply_markup=SKIP_TEXT_KB, parse_mode="Markdown")
     await callback.answer()
 
 # --- ФИНАЛЬНАЯ ГЕНЕРАЦИЯ (С ТЕКСТОМ ИЛИ БЕЗ) ---
 
-async def perform_generation(message: types.Message, state: FSMContext, user_text: str = None, retry_count: int = 0):
-    """Общая функция для генерации и отправки, вызывается из двух хэндлеров ниже."""
+# Как часто можно обновлять сообщение с местом в очереди (секунды)
+QUEUE_POSITION_EDIT_INTERVAL = 3
+# Минимальный таймаут отправки открытки в Telegram, даже если дедлайн почти истек
+UPLOAD_MIN_TIMEOUT = 10
+
+class QueuePositionStatus:
+    """
+    Показывает место в очереди в статусном сообщении не чаще раза в QUEUE_POSITION_EDIT_INTERVAL
+    секунд, чтобы не упереться в лимиты Telegram. Место, пришедшее внутри интервала, не теряется:
+    последнее из них показывается, как только интервал закончится.
+    """
+
+    def __init__(self, status_msg: types.Message):
+        self.status_msg = status_msg
+        self._shown = None
+        self._latest = None
+        self._edited_at = None
+        self._pending = None
+
+    async def update(self, position: int):
+        """on_position для generation_scheduler.submit"""
+        self._latest = position
+        if self._pending:
+            return
+        wait = 0.0
+        if self._edited_at is not None:
+            wait = QUEUE_POSITION_EDIT_INTERVAL - (asyncio.get_running_loop().time() - self._edited_at)
+        if wait <= 0:
+            await self._edit()
+        else:
+            self._pending = asyncio.create_task(self._edit_later(wait))
+
+    def stop(self):
+        """Генерация началась или завершилась - отложенное обновление уже не нужно"""
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+
+    async def _edit_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._pending = None
+        try:
+            await self._edit()
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить место в очереди: {e}")
+
+    async def _edit(self):
+        position = self._latest
+        if position == self._shown:
+            return
+        self._edited_at = asyncio.get_running_loop().time()
+        self._shown = position
+        try:
+            await self.status_msg.edit_text(
+                f"⏳ Сейчас много желающих создать открытку. Ваше место в очереди: {position}.\n"
+                f"Генерация начнется автоматически, пожалуйста, подождите."
+            )
+        except TelegramBadRequest as e:
+            # Текст уже такой же - это не ошибка
+            if "message is not modified" not in str(e):
+                raise
+
+async def perform_generation(message: types.Message, state: FSMContext, user_text: str = None, retry_count: int = 0,
+                             deadline: Deadline = None):
+    """
+    Общая функция для генерации и отправки, вызывается из двух хэндлеров ниже.
+    deadline - общий срок на всю открытку, каждый этап берет таймаут из остатка.
+    """
+    deadline = deadline or Deadline()
     data = await state.get_data()
     # #region agent log
     debug_log("bot.py:263", "perform_generation ENTRY", {"state_data": data, "user_text_length": len(user_text) if user_text else 0}, "B")
@@ -546,10 +817,10 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
     # ВАЛИДАЦИЯ: Проверяем соответствие topic и country перед генерацией (гипотеза B)
     avail_topics = tc.get_available_topics(country_code)
     # #region agent log
-    debug_log("bot.py:287", "perform_generation VALIDATION CHECK", {"country": country_code, "topic": topic_code, "available_topics": avail_topics, "is_valid": topic_code in avail_topics}, "B")
+    debug_log("bot.py:287", "perform_generation VALIDATION CHECK", {"country": country_code, "topic": topic_code, "available_topics": avail_topics, "is_valid": tc.is_topic_available(country_code, topic_code)}, "B")
     # #endregion
     
-    if topic_code not in avail_topics:
+    if not tc.is_topic_available(country_code, topic_code):
         # #region agent log
         debug_log("bot.py:291", "perform_generation VALIDATION FAILED", {"country": country_code, "invalid_topic": topic_code, "available_topics": avail_topics}, "B")
         # #endregion
@@ -570,35 +841,70 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
     # #region agent log
     debug_log("bot.py:190", "build_final_prompt CALL", {"country": country_code, "topic": topic_code}, "C")
     # #endregion
-    final_prompt = tc.build_final_prompt(country_code, topic_code)
+    final_prompt, prompt_variant = tc.build_final_prompt(country_code, topic_code)
+    logging.info(f"Промпт {country_code}/{topic_code}, вариант {prompt_variant}")
     ai_image_io = None
+    # Генерация (очередь, ожидание Gemini, повторы) заканчивается раньше общего дедлайна:
+    # остаток нужен, чтобы собрать открытку хотя бы на запасном фоне
+    generation_deadline = deadline.reserve(ai_service.COMPOSE_RESERVE)
+    
+    # Фон мог начать генерироваться еще пока пользователь писал текст
+    speculative_task = pop_speculative_generation(state, country_code, topic_code)
+    if speculative_task:
+        try:
+            ai_image_io = await asyncio.wait_for(speculative_task, timeout=generation_deadline.remaining())
+        except asyncio.TimeoutError:
+            logging.warning("Спекулятивная генерация не успела до дедлайна")
+        except Exception as e:
+            logging.warning(f"Спекулятивная генерация не удалась: {e}")
+    
+    # Иначе пробуем взять готовый фон из пула - тогда остается только композиция
+    if not ai_image_io:
+        ai_image_io = background_pool.take(country_code, topic_code)
+    
+    # Показываем место в очереди, пока генерация ждет свободного слота
+    queue_status = QueuePositionStatus(status_msg)
     
     for attempt in range(max_retries + 1):
+        if ai_image_io:
+            break
         try:
             if attempt > 0:
+                # Повтор, который уже не успеет, не запускаем
+                generation_deadline.ensure(ai_service.MIN_GENERATION_TIME, "generation retry")
+                # Паузу между попытками держит общий регулятор квоты в ai_service
                 await status_msg.edit_text(f"🔄 Повторная попытка генерации изображения... (попытка {attempt + 1}/{max_retries + 1})")
-                await asyncio.sleep(2)
             
-            ai_image_io = await ai_service.generate_image_bytes(final_prompt)
+            # Вариант промпта входит в ключ объединения одинаковых запросов
+            try:
+                ai_image_io = await generation_scheduler.submit(
+                    state.key.user_id, final_prompt, on_position=queue_status.update, deadline=generation_deadline,
+                    variant=prompt_variant
+                )
+            finally:
+                # Устаревшее место в очереди не должно перезаписать следующий статус
+                queue_status.stop()
             if ai_image_io:
                 break
             elif attempt < max_retries:
                 logging.warning(f"Генерация вернула None, попытка {attempt + 1}/{max_retries + 1}")
                 continue
-        except asyncio.TimeoutError:
-            logging.error(f"Timeout при генерации изображения (попытка {attempt + 1})")
-            if attempt == max_retries:
-                await status_msg.edit_text(
-                    "⚠️ **Превышено время ожидания**\n\n"
-                    "Генерация изображения заняла слишком много времени.\n"
-                    "Возможные причины:\n"
-                    "• Перегрузка API Google Gemini\n"
-                    "• Слишком сложный запрос\n"
-                    "• Проблемы с интернет-соединением\n\n"
-                    "Попробуйте позже или начните заново командой /start"
-                )
-                await state.clear()
-                return
+        except ai_service.CircuitOpenError:
+            # Gemini массово отвечает ошибками - не повторяем, ниже попробуем запасной фон
+            logging.warning("Автомат Gemini разомкнут, используем запасной фон")
+            break
+        except DeadlineExceeded as e:
+            # Время на открытку почти вышло - не ждем дальше, ниже попробуем запасной фон
+            logging.warning(f"Дедлайн генерации: {e}")
+            break
+        except QueueFull:
+            # Очередь переполнена - не ждем и не повторяем, состояние сохраняем для повторной отправки
+            logging.warning(f"Очередь генерации переполнена, запрос пользователя {state.key.user_id} отклонен")
+            await status_msg.edit_text(
+                "⏳ **Сейчас слишком много запросов**\n\n"
+                "Мы создаем очень много открыток одновременно. Пожалуйста, отправьте ваш текст еще раз через минуту."
+            )
+            return
         except Exception as e:
             logging.error(f"Ошибка генерации изображения (попытка {attempt + 1}): {e}")
             if attempt == max_retries:
@@ -613,6 +919,14 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
                 await state.clear()
                 return
     
+    # Gemini не справился - берем запасной фон из пула (свежий или уже использованный)
+    if not ai_image_io:
+        ai_image_io = background_pool.take_fallback(country_code, topic_code)
+    # Пул пуст (например, сразу после перезапуска) - берем недавний фон темы из дискового кэша,
+    # любого варианта промпта
+    if not ai_image_io:
+        ai_image_io = await ai_service.cached_background(tc.build_variant_prompts(country_code, topic_code))
+    
     if not ai_image_io:
         await status_msg.edit_text(
             "⚠️ **Ошибка генерации изображения**\n\n"
@@ -626,7 +940,16 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
     # Убрали сообщение про компоновку - оно мелькает слишком быстро
     
     try:
-        final_card_io = await ai_service.compose_final_card(ai_image_io, user_text)
+        final_card_io = await ai_service.compose_final_card(ai_image_io, user_text, topic_code, deadline=deadline)
+    except DeadlineExceeded as e:
+        logging.error(f"Дедлайн сборки открытки: {e}")
+        await status_msg.edit_text(
+            "⚠️ **Превышено время ожидания**\n\n"
+            "Не удалось вовремя собрать открытку.\n"
+            "Попробуйте позже или начните заново командой /start"
+        )
+        await state.clear()
+        return
     except Exception as e:
         logging.error(f"Ошибка композиции открытки: {e}")
         await status_msg.edit_text(
@@ -654,12 +977,13 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
         country_code = data.get('country')
         
         # Кнопка "Создать еще одну" - возврат к выбору темы для той же страны
-        restart_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Создать еще одну", callback_data=f"create_another:{country_code}")]
-        ])
+        restart_kb = RESTART_KBS[country_code]
         
         await status_msg.delete()
-        await bot.send_photo(chat_id=message.chat.id, photo=input_file, caption=caption, reply_markup=restart_kb)
+        await bot.send_photo(
+            chat_id=message.chat.id, photo=input_file, caption=caption, reply_markup=restart_kb,
+            request_timeout=int(deadline.timeout(floor=UPLOAD_MIN_TIMEOUT))
+        )
         
         # НЕ очищаем state сразу - он нужен для кнопки "Создать еще одну"
         # State будет очищен при следующем /start или в create_another
@@ -674,6 +998,8 @@ async def perform_generation(message: types.Message, state: FSMContext, user_tex
 # Хэндлер 1: Пользователь прислал текст
 @dp.message(CardGen.waiting_for_text, F.text)
 async def text_received(message: types.Message, state: FSMContext):
+    # Отсчет дедлайна начинается с момента, когда пользователь прислал текст
+    deadline = Deadline()
     if len(message.text) > 200:
         await message.answer(
             f"⚠️ Ваш текст слишком длинный ({len(message.text)} символов).\n"
@@ -682,16 +1008,17 @@ async def text_received(message: types.Message, state: FSMContext):
         )
         return
     # Вызываем общую функцию с полученным текстом
-    await perform_generation(message, state, user_text=message.text)
+    await perform_generation(message, state, user_text=message.text, deadline=deadline)
 
 # Хэндлер 2: Пользователь нажал "Skip Text"
 @dp.callback_query(CardGen.waiting_for_text, F.data == "skip_text")
 async def skip_text_action(callback: CallbackQuery, state: FSMContext):
     # --- ОБНОВЛЕННЫЙ ТЕКСТ ПО УМОЛЧАНИЮ ---
-    default_text = "Season's Greetings and best wishes for a prosperous and successful New Year!"
+    default_text = tc.DEFAULT_CARD_TEXT
+    deadline = Deadline()
     
     # Вызываем генерацию с этим текстом
-    await perform_generation(callback.message, state, user_text=default_text)
+    await perform_generation(callback.message, state, user_text=default_text, deadline=deadline)
     await callback.answer()
 
 # --- БЫСТРОЕ СОЗДАНИЕ ЕЩЕ ОДНОЙ ОТКРЫТКИ ---
@@ -716,6 +1043,7 @@ async def create_another_action(callback: CallbackQuery, state: FSMContext):
             return
         
         # Восстанавливаем состояние с выбранной страной, ОЧИЩАЕМ topic (гипотеза E)
+        cancel_speculative_generation(state)
         await state.update_data(country=country_code, topic=None)
         # #region agent log
         state_data = await state.get_data()
@@ -724,12 +1052,10 @@ async def create_another_action(callback: CallbackQuery, state: FSMContext):
         await state.set_state(CardGen.choosing_topic)
         
         # Показываем выбор тем для этой страны
-        avail_topics_keys = tc.get_available_topics(country_code)
-        filtered_topics = {k: tc.TOPICS[k] for k in avail_topics_keys}
         tip_text = tc.get_tips(country_code)
         
         # Создаем клавиатуру с темами и кнопкой "Мне повезет" по 2 в ряд
-        kb = make_topics_kb(filtered_topics, country_code)
+        kb = get_topics_kb(country_code)
         
         # ИСПРАВЛЕНИЕ: Нельзя редактировать фото через edit_text()
         # Просто отправляем новое текстовое сообщение с выбором тем
@@ -746,6 +1072,7 @@ async def create_another_action(callback: CallbackQuery, state: FSMContext):
 # --- ОБРАБОТКА ОТМЕНЫ ---
 @dp.callback_query(F.data == "cancel")
 async def cancel_action(callback: CallbackQuery, state: FSMContext):
+    cancel_speculative_generation(state)
     await state.clear()
     await callback.message.edit_text(
         "Создание открытки остановлено.\n\n"
@@ -770,10 +1097,12 @@ async def cmd_admin(message: types.Message):
         "🔐 **Панель администратора**\n\n"
         "Доступные команды:\n\n"
         "📊 `/stats` - Статистика пользователей\n"
-        "👥 `/users` - Выгрузка CSV файла со всеми пользователями\n"
+        "👥 `/users [с] [по]` - Выгрузка пользователей в CSV (gzip), можно за период ГГГГ-ММ-ДД\n"
+        "📖 `/users_page` - Просмотр пользователей по страницам\n"
         "🔍 `/user_info <user_id>` - Информация о пользователе\n"
         "🗑️ `/delete_user <user_id>` - Удалить пользователя\n"
-        "📢 `/broadcast <сообщение>` - Рассылка сообщений\n"
+        "📢 `/broadcast <сообщение>` - Рассылка сообщений (в фоне)\n"
+        "⏹️ `/broadcast_stop` - Остановить рассылку\n"
         "💾 `/db_stats` - Статистика базы данных\n"
         "❓ `/help_admin` - Показать это меню"
     )
@@ -790,19 +1119,21 @@ async def cmd_stats(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
     
     try:
-        total_users = await get_users_count()
-        new_users_today = await get_recent_users(1)
-        new_users_week = await get_recent_users(7)
-        new_users_month = await get_recent_users(30)
+        if not db_pool:
+            await message.answer("❌ База данных не инициализирована.")
+            return
         
+        counters = await user_stats.get(db_pool)
         stats_text = (
             f"📊 **Статистика пользователей**\n\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"🆕 Новых сегодня: {new_users_today}\n"
-            f"📅 Новых за неделю: {new_users_week}\n"
-            f"📆 Новых за месяц: {new_users_month}"
+            f"👥 Всего пользователей: {counters.total}\n"
+            f"🆕 Новых сегодня: {counters.today}\n"
+            f"📅 Новых за неделю: {counters.week}\n"
+            f"📆 Новых за месяц: {counters.month}"
         )
         await message.answer(stats_text, parse_mode="Markdown")
     except Exception as e:
@@ -811,67 +1142,139 @@ async def cmd_stats(message: types.Message):
 
 @dp.message(Command("users"))
 async def cmd_users(message: types.Message):
-    """Выгрузка CSV файла со всеми пользователями"""
+    """Выгрузка пользователей в сжатый CSV (можно ограничить датами регистрации)"""
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
+    
+    try:
+        since, until = user_export.parse_date_range(message.text.split()[1:])
+    except ValueError:
+        await message.answer(
+            "❌ Использование: `/users [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]`\n\n"
+            "Пример: `/users 2024-01-01 2024-01-31`",
+            parse_mode="Markdown"
+        )
+        return
     
     try:
-        # Получаем всех пользователей (без лимита)
         if not db_pool:
             await message.answer("❌ База данных не инициализирована.")
             return
         
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT user_id, username, joined_at FROM users ORDER BY joined_at DESC"
+        # CSV формирует Postgres, файл сжимается и отправляется по кускам
+        export = await user_export.export_users_csv(db_pool, since, until)
+        try:
+            if not export.rows:
+                await message.answer("📋 Пользователи не найдены.")
+                return
+            
+            period = ""
+            if since or until:
+                period = (
+                    f"📅 Период: {since.strftime('%d.%m.%Y') if since else '...'}"
+                    f" - {(until - timedelta(days=1)).strftime('%d.%m.%Y') if until else '...'}\n"
+                )
+            await message.answer(
+                f"📊 **Выгрузка пользователей**\n\n"
+                f"{period}"
+                f"✅ Всего пользователей: {export.rows}\n"
+                f"📁 Файл готов к скачиванию",
+                parse_mode="Markdown"
             )
-            users = [dict(row) for row in rows]
-        
-        total_users = len(users)
-        
+            await bot.send_document(
+                chat_id=message.chat.id,
+                document=export.file,
+                caption=f"📋 Список пользователей ({export.rows} записей, CSV в gzip)"
+            )
+        finally:
+            export.file.close()
+    except Exception as e:
+        logging.error(f"Ошибка в cmd_users: {e}", exc_info=True)
+        await message.answer("❌ Ошибка при выгрузке списка пользователей.")
+
+# Сколько пользователей показывать на странице /users_page
+USERS_PAGE_SIZE = 20
+USERS_PAGE_EPOCH = datetime(1970, 1, 1)
+
+def encode_users_cursor(direction: str, user: dict) -> str:
+    """callback_data кнопки страницы: направление и курсор (время регистрации в микросекундах, user_id)"""
+    micros = (user['joined_at'] - USERS_PAGE_EPOCH) // timedelta(microseconds=1)
+    # Не длиннее 52 символов - укладывается в лимит Telegram 64 байта
+    return f"users_page:{direction}:{micros}:{user['user_id']}"
+
+def decode_users_cursor(data: str):
+    """Обратное к encode_users_cursor: (newer, (joined_at, user_id)); бросает ValueError"""
+    _, direction, micros, user_id = data.split(":")
+    if direction not in ("next", "prev"):
+        raise ValueError(f"unknown direction {direction}")
+    joined_at = USERS_PAGE_EPOCH + timedelta(microseconds=int(micros))
+    return direction == "prev", (joined_at, int(user_id))
+
+def build_users_page(users: list, has_prev: bool, has_next: bool):
+    """Текст страницы и кнопки навигации"""
+    lines = ["👥 Пользователи (сначала новые)\n"]
+    for user in users:
+        username = f"@{user['username']}" if user['username'] else "без username"
+        lines.append(f"🆔 {user['user_id']} · {username} · {user['joined_at'].strftime('%d.%m.%Y %H:%M')}")
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=encode_users_cursor("prev", users[0])))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Старее ➡️", callback_data=encode_users_cursor("next", users[-1])))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+@dp.message(Command("users_page"))
+async def cmd_users_page(message: types.Message):
+    """Просмотр пользователей по страницам"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
+    
+    try:
+        users, has_next = await get_users_page(USERS_PAGE_SIZE)
         if not users:
             await message.answer("📋 Пользователи не найдены.")
             return
-        
-        # Создаем CSV файл в памяти
-        csv_buffer = io.StringIO()
-        csv_writer = csv.writer(csv_buffer)
-        
-        # Записываем заголовки
-        csv_writer.writerow(['user_id', 'username', 'joined_at'])
-        
-        # Записываем данные
-        for user in users:
-            user_id = user['user_id']
-            username = user['username'] or ''
-            joined_at = user['joined_at'].strftime("%Y-%m-%d %H:%M:%S") if user['joined_at'] else ''
-            csv_writer.writerow([user_id, username, joined_at])
-        
-        # Конвертируем в bytes для отправки
-        csv_bytes = csv_buffer.getvalue().encode('utf-8-sig')  # utf-8-sig для правильного отображения в Excel
-        csv_buffer.close()
-        
-        # Создаем файл для отправки
-        input_file = BufferedInputFile(
-            csv_bytes,
-            filename=f"users_export_{total_users}.csv"
-        )
-        
-        await message.answer(
-            f"📊 **Выгрузка пользователей**\n\n"
-            f"✅ Всего пользователей: {total_users}\n"
-            f"📁 Файл готов к скачиванию",
-            parse_mode="Markdown"
-        )
-        await bot.send_document(
-            chat_id=message.chat.id,
-            document=input_file,
-            caption=f"📋 Список всех пользователей ({total_users} записей)"
-        )
+        text, keyboard = build_users_page(users, has_prev=False, has_next=has_next)
+        await message.answer(text, reply_markup=keyboard)
     except Exception as e:
-        logging.error(f"Ошибка в cmd_users: {e}", exc_info=True)
-        await message.answer("❌ Ошибка при выгрузке списка пользователей.")
+        logging.error(f"Ошибка в cmd_users_page: {e}")
+        await message.answer("❌ Ошибка при получении списка пользователей.")
+
+@dp.callback_query(F.data.startswith("users_page:"))
+async def users_page_callback(callback: CallbackQuery):
+    """Переход на соседнюю страницу /users_page"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет доступа к этой команде.", show_alert=True)
+        return
+    
+    try:
+        newer, cursor = decode_users_cursor(callback.data)
+    except ValueError:
+        await callback.answer("❌ Неверная кнопка.", show_alert=True)
+        return
+    
+    try:
+        users, has_more = await get_users_page(USERS_PAGE_SIZE, cursor, newer=newer)
+        if not users:
+            await callback.answer("📋 Дальше пользователей нет.", show_alert=True)
+            return
+        # Пришли со стороны курсора - там записи точно есть
+        if newer:
+            text, keyboard = build_users_page(users, has_prev=has_more, has_next=True)
+        else:
+            text, keyboard = build_users_page(users, has_prev=True, has_next=has_more)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        logging.error(f"Ошибка в users_page_callback: {e}")
+        await callback.answer("❌ Ошибка при получении списка пользователей.", show_alert=True)
 
 @dp.message(Command("user_info"))
 async def cmd_user_info(message: types.Message):
@@ -879,6 +1282,8 @@ async def cmd_user_info(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
     
     try:
         parts = message.text.split()
@@ -915,6 +1320,8 @@ async def cmd_delete_user(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
     
     try:
         parts = message.text.split()
@@ -955,38 +1362,28 @@ async def cmd_db_stats(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
     
     try:
-        total_users = await get_users_count()
-        new_users_today = await get_recent_users(1)
-        new_users_week = await get_recent_users(7)
-        new_users_month = await get_recent_users(30)
-        
-        # Получаем информацию о самой старой и новой регистрации
-        if db_pool:
-            async with db_pool.acquire() as conn:
-                oldest_user = await conn.fetchrow(
-                    "SELECT user_id, username, joined_at FROM users ORDER BY joined_at ASC LIMIT 1"
-                )
-                newest_user = await conn.fetchrow(
-                    "SELECT user_id, username, joined_at FROM users ORDER BY joined_at DESC LIMIT 1"
-                )
-        else:
-            oldest_user = None
-            newest_user = None
+        if not db_pool:
+            await message.answer("❌ База данных не инициализирована.")
+            return
         
+        # Счетчики, первая и последняя регистрация - одним запросом
+        counters = await user_stats.get(db_pool)
         stats_text = (
             f"💾 **Статистика базы данных**\n\n"
-            f"👥 Всего пользователей: {total_users}\n\n"
+            f"👥 Всего пользователей: {counters.total}\n\n"
             f"📈 **Новые регистрации:**\n"
-            f"   Сегодня: {new_users_today}\n"
-            f"   За неделю: {new_users_week}\n"
-            f"   За месяц: {new_users_month}\n\n"
+            f"   Сегодня: {counters.today}\n"
+            f"   За неделю: {counters.week}\n"
+            f"   За месяц: {counters.month}\n\n"
         )
         
-        if oldest_user and newest_user:
-            oldest_date = oldest_user['joined_at'].strftime("%d.%m.%Y") if oldest_user['joined_at'] else "неизвестно"
-            newest_date = newest_user['joined_at'].strftime("%d.%m.%Y") if newest_user['joined_at'] else "неизвестно"
+        if counters.total:
+            oldest_date = counters.first_joined.strftime("%d.%m.%Y") if counters.first_joined else "неизвестно"
+            newest_date = counters.last_joined.strftime("%d.%m.%Y") if counters.last_joined else "неизвестно"
             stats_text += (
                 f"📅 **Период:**\n"
                 f"   Первая регистрация: {oldest_date}\n"
@@ -998,12 +1395,47 @@ async def cmd_db_stats(message: types.Message):
         logging.error(f"Ошибка в cmd_db_stats: {e}")
         await message.answer("❌ Ошибка при получении статистики базы данных.")
 
+# Текущая рассылка (одновременно идет не больше одной)
+active_broadcast = None
+
+def format_broadcast_status(job: Broadcast) -> str:
+    """Текст статуса рассылки"""
+    if not job.done:
+        title = "📢 **Идет рассылка**"
+    elif job.error:
+        title = "⚠️ **Рассылка прервана из-за ошибки**"
+    elif job.cancelled:
+        title = "⏹️ **Рассылка остановлена**"
+    else:
+        title = "✅ **Рассылка завершена**"
+    speed = job.processed / job.elapsed if job.elapsed > 0 else 0
+    text = (
+        f"{title}\n\n"
+        f"✅ Успешно: {job.sent}\n"
+        f"🚫 Заблокировали бота: {job.blocked}\n"
+        f"❌ Ошибок: {job.failed}\n"
+        f"📊 Обработано: {job.processed} из ~{job.total}\n"
+        f"⚡ Скорость: {speed:.1f} сообщ./с"
+    )
+    if job.error:
+        # Текст ошибки экранируем, чтобы он не сломал разметку Markdown
+        error = "".join(f"\\{ch}" if ch in "_*`[" else ch for ch in job.error)
+        text += f"\n\n⚠️ Ошибка: {error}\nОстальные пользователи сообщение не получили."
+    if job.paused_for > 0 and not job.done:
+        text += f"\n🚦 Пауза по лимиту Telegram: {job.paused_for:.0f} с"
+    if not job.done:
+        text += "\n\nОстановить: /broadcast\\_stop"
+    return text
+
 @dp.message(Command("broadcast"))
 async def cmd_broadcast(message: types.Message):
-    """Рассылка сообщений всем пользователям"""
+    """Рассылка сообщений всем пользователям (в фоне)"""
+    global active_broadcast
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
+    # Новые пользователи могут еще лежать в буфере регистрации
+    await user_registry.flush()
     
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
@@ -1014,36 +1446,59 @@ async def cmd_broadcast(message: types.Message):
         )
         return
     
-    users = await get_all_users()
-    if not users:
-        await message.answer("❌ Нет пользователей для рассылки.")
+    if active_broadcast and not active_broadcast.done:
+        await message.answer("❌ Рассылка уже идет. Дождитесь окончания или остановите ее: /broadcast_stop")
         return
     
-    msg = await message.answer(f"📢 Начинаю рассылку для {len(users)} пользователей...")
-    count = 0
-    failed = 0
+    if not db_pool:
+        await message.answer("❌ База данных не инициализирована.")
+        return
+    
+    total = len(user_registry)
+    msg = await message.answer(f"📢 Начинаю рассылку для ~{total} пользователей...")
     
-    for uid in users:
+    async def show_progress(job: Broadcast):
         try:
-            await bot.send_message(uid, parts[1])
-            count += 1
-            await asyncio.sleep(0.05)  # Задержка, чтобы не превысить лимиты Telegram
-        except Exception as e:
-            failed += 1
-            logging.warning(f"Не удалось отправить сообщение пользователю {uid}: {e}")
-    
-    await msg.edit_text(
-        f"✅ **Рассылка завершена**\n\n"
-        f"✅ Успешно: {count}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"📊 Всего: {len(users)}",
-        parse_mode="Markdown"
-    )
+            await msg.edit_text(format_broadcast_status(job), parse_mode="Markdown")
+        except TelegramBadRequest as e:
+            # Счетчики не изменились с прошлого обновления
+            if "message is not modified" not in str(e):
+                raise
+    
+    # Рассылка идет в фоне, обработчик сразу освобождается; ход виден в статусном сообщении
+    active_broadcast = Broadcast(bot, db_pool, parts[1], total=total, on_progress=show_progress)
+    active_broadcast.start()
+
+@dp.message(Command("broadcast_stop"))
+async def cmd_broadcast_stop(message: types.Message):
+    """Остановка текущей рассылки"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+    
+    if not active_broadcast or active_broadcast.done:
+        await message.answer("❌ Сейчас рассылка не идет.")
+        return
+    
+    await active_broadcast.cancel()
+    await message.answer(f"⏹️ Рассылка остановлена. Успешно отправлено: {active_broadcast.sent}")
 
 async def main():
     """Основная функция запуска бота"""
     try:
         await init_db()
+        try:
+            await user_registry.load()
+        except Exception as e:
+            # Без загруженного списка все пользователи считаются новыми - ON CONFLICT не даст задвоить
+            logging.error(f"Не удалось загрузить пользователей в память: {e}")
+        user_registry.start()
+        # Шаблонный текст встречается чаще всего - процессы-сборщики отрисуют его заранее
+        ai_service.start_compose_pool(warm_texts=[tc.DEFAULT_CARD_TEXT])
+        # После деплоя наполняем пул фонами с диска, а не генерируем все заново
+        await ai_service.load_image_cache()
+        await background_pool.warm(ai_service.cached_backgrounds)
+        background_pool.start()
         await bot.delete_webhook(drop_pending_updates=True)
         logging.info("🚀 Бот запущен и готов к работе")
         await dp.start_polling(bot, handle_as_tasks=True)
@@ -1054,6 +1509,27 @@ async def main():
         raise
     finally:
         logging.info("Завершаю работу бота...")
+        try:
+            if active_broadcast:
+                await active_broadcast.cancel()
+        except Exception as e:
+            logging.error(f"Ошибка при остановке рассылки: {e}")
+        try:
+            await background_pool.stop()
+        except Exception as e:
+            logging.error(f"Ошибка при остановке пула фонов: {e}")
+        try:
+            ai_service.save_image_cache()
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении индекса кэша фонов: {e}")
+        try:
+            ai_service.shutdown_compose_pool()
+        except Exception as e:
+            logging.error(f"Ошибка при остановке пула сборки открыток: {e}")
+        try:
+            await user_registry.stop()
+        except Exception as e:
+            logging.error(f"Ошибка при записи новых пользователей: {e}")
         try:
             await close_db()
         except Exception as e:
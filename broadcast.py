@@ -0,0 +1,178 @@
+"""
+Рассылка сообщения всем пользователям в фоне.
+
+Получатели читаются из базы пачками по первичному ключу, сообщения отправляют
+несколько воркеров одновременно, а общий token bucket держит скорость чуть ниже
+лимита Telegram. Если Telegram ответил 429 (RetryAfter), ведро ставится на паузу
+для всех воркеров, и сообщение отправляется повторно. Ход рассылки периодически
+передается в on_progress.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+from rate_limit import TokenBucket
+
+# --- КОНФИГУРАЦИЯ ---
+# Сколько сообщений в секунду отправлять (лимит Telegram - около 30 в секунду на бота)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# Сколько сообщений может отправляться одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Сколько получателей читать из базы за один запрос
+BROADCAST_BATCH = 1000
+# Сколько раз повторять сообщение после RetryAfter
+BROADCAST_MAX_RETRIES = 3
+# Как часто сообщать о ходе рассылки (секунды)
+BROADCAST_PROGRESS_INTERVAL = 5
+
+
+class Broadcast:
+    """Одна рассылка: счетчики, фоновая задача и ее остановка."""
+
+    def __init__(self, bot, pool, text: str, total: int = 0, on_progress=None,
+                 rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        # on_progress: async функция (broadcast) -> None, вызывается раз в BROADCAST_PROGRESS_INTERVAL и в конце
+        self.bot = bot
+        self.pool = pool
+        self.text = text
+        self.total = total
+        self.concurrency = max(1, concurrency)
+        self._on_progress = on_progress
+        # Всплеск не больше секунды лимита
+        self._bucket = TokenBucket(rate=rate, capacity=rate)
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retried = 0
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+        # Текст ошибки, из-за которой рассылка прервалась (например, сбой базы), или None
+        self.error = None
+        self._task = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def paused_for(self) -> float:
+        """Сколько секунд осталось до конца паузы по RetryAfter"""
+        return self._bucket.paused_for
+
+    def start(self):
+        """Запускает рассылку фоновой задачей"""
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def cancel(self):
+        """Останавливает рассылку и ждет, пока воркеры завершатся"""
+        if self._task and not self._task.done():
+            self.cancelled = True
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _recipients(self):
+        """user_id всех пользователей пачками: каждая пачка - короткий запрос по первичному ключу"""
+        last_id = None
+        while True:
+            async with self.pool.acquire() as conn:
+                if last_id is None:
+                    rows = await conn.fetch("SELECT user_id FROM users ORDER BY user_id LIMIT $1", BROADCAST_BATCH)
+                else:
+                    rows = await conn.fetch(
+                        "SELECT user_id FROM users WHERE user_id > $2 ORDER BY user_id LIMIT $1",
+                        BROADCAST_BATCH, last_id
+                    )
+            for row in rows:
+                yield row['user_id']
+            if len(rows) < BROADCAST_BATCH:
+                return
+            last_id = rows[-1]['user_id']
+
+    async def _run(self):
+        self.started_at = time.monotonic()
+        # Очередь небольшая: читаем из базы не больше, чем воркеры успевают отправить
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            async for user_id in self._recipients():
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except Exception as e:
+            # Часть пользователей осталась без сообщения - это должно быть видно в статусе
+            self.error = str(e) or type(e).__name__
+            logging.error(f"Рассылка прервана: {e}", exc_info=True)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            self.finished_at = time.monotonic()
+            logging.info(
+                f"📢 Рассылка {'прервана' if self.error else 'остановлена' if self.cancelled else 'завершена'}: "
+                f"отправлено {self.sent}, "
+                f"заблокировали бота {self.blocked}, ошибок {self.failed}, повторов {self.retried}, "
+                f"{self.elapsed:.0f} с"
+            )
+            await self._report()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            await self._deliver(user_id)
+
+    async def _deliver(self, user_id: int):
+        for _ in range(BROADCAST_MAX_RETRIES + 1):
+            await self._bucket.acquire()
+            try:
+                await self.bot.send_message(user_id, self.text)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Лимит превышен: пауза для всех воркеров, потом повтор
+                self.retried += 1
+                self._bucket.pause(e.retry_after)
+                logging.warning(f"🚦 Рассылка: Telegram просит подождать {e.retry_after} с")
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота
+                self.blocked += 1
+                return
+            except Exception as e:
+                self.failed += 1
+                logging.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                return
+        self.failed += 1
+        logging.warning(f"Не удалось отправить сообщение пользователю {user_id}: лимит повторов после RetryAfter")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._report()
+
+    async def _report(self):
+        if not self._on_progress:
+            return
+        try:
+            await self._on_progress(self)
+        except Exception as e:
+            logging.warning(f"Не удалось обновить ход рассылки: {e}")
@@ -0,0 +1,123 @@
+"""
+Макеты открыток и заранее отрисованные статические слои.
+
+Фон, подложка под текст и рамка не зависят от картинки и текста, поэтому для каждого
+макета они рисуются один раз: открытка начинается с копии шаблона, поверх кладется
+AI картинка, рамка восстанавливается только там, где ее перекрыла картинка, и рисуется текст.
+"""
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+Color = Tuple[int, int, int]
+Box = Tuple[int, int, int, int]  # x, y, ширина, высота
+
+
+class CardLayout(NamedTuple):
+    """Геометрия и цвета одного макета открытки"""
+    name: str
+    canvas_size: Tuple[int, int]
+    bg_color: Color
+    image_box: Box
+    text_box: Box
+    text_color: Color
+    frame_color: Color
+    frame_width: int
+    # Линия вокруг AI картинки (0 - нет)
+    image_border_width: int = 0
+    # Подложка под текст: цвет, прямоугольник, радиус скругления, обводка
+    backdrop_color: Optional[Color] = None
+    backdrop_box: Optional[Box] = None
+    backdrop_radius: int = 0
+    backdrop_outline_width: int = 0
+
+
+class CardTemplate:
+    """Готовый статический слой макета и участки рамки, которые лежат поверх картинки"""
+
+    def __init__(self, layout: CardLayout):
+        self.layout = layout
+        self.base = self._render_base(layout)
+
+        # Рамка рисуется поверх картинки: запоминаем участки шаблона, которые картинка перекроет
+        x, y, width, height = layout.image_box
+        self.patches = self._frame_patches((x, y, x + width, y + height))
+
+    def _frame_patches(self, area):
+        """Участки рамки внутри area (left, top, right, bottom): [((x, y), плитка шаблона)]"""
+        patches = []
+        for band in self._frame_bands(self.layout):
+            left, top = max(band[0], area[0]), max(band[1], area[1])
+            right, bottom = min(band[2], area[2]), min(band[3], area[3])
+            if left < right and top < bottom:
+                patches.append(((left, top), self.base.crop((left, top, right, bottom))))
+        return patches
+
+    @staticmethod
+    def _frame_bands(layout: CardLayout):
+        """Рамка по краю холста как четыре сплошные полосы (left, top, right, bottom)"""
+        width, height = layout.canvas_size
+        frame = layout.frame_width
+        if frame <= 0:
+            return []
+        return [
+            (0, 0, width, frame),
+            (0, height - frame, width, height),
+            (0, 0, frame, height),
+            (width - frame, 0, width, height),
+        ]
+
+    @classmethod
+    def _render_base(cls, layout: CardLayout):
+        canvas = Image.new("RGB", layout.canvas_size, layout.bg_color)
+        draw = ImageDraw.Draw(canvas)
+
+        if layout.backdrop_color and layout.backdrop_box:
+            x, y, width, height = layout.backdrop_box
+            draw.rounded_rectangle(
+                [(x, y), (x + width - 1, y + height - 1)],
+                radius=layout.backdrop_radius,
+                fill=layout.backdrop_color,
+                outline=layout.frame_color if layout.backdrop_outline_width else None,
+                width=layout.backdrop_outline_width
+            )
+
+        if layout.image_border_width > 0:
+            x, y, width, height = layout.image_box
+            border = layout.image_border_width
+            draw.rectangle(
+                [(x - border, y - border), (x + width + border - 1, y + height + border - 1)],
+                outline=layout.frame_color,
+                width=border
+            )
+
+        if layout.frame_width > 0:
+            draw.rectangle(
+                [(0, 0), (layout.canvas_size[0] - 1, layout.canvas_size[1] - 1)],
+                outline=layout.frame_color,
+                width=layout.frame_width
+            )
+        return canvas
+
+    def new_canvas(self):
+        """Новая открытка: копия статического слоя"""
+        return self.base.copy()
+
+    def paste_image(self, canvas, image):
+        """Кладет AI картинку (уже нужного размера) и восстанавливает рамку поверх нее"""
+        x, y = self.layout.image_box[:2]
+        canvas.paste(image, (x, y))
+        for position, patch in self.patches:
+            canvas.paste(patch, position)
+
+    def restore_frame(self, canvas, area):
+        """Возвращает рамку поверх всего, что нарисовано в area (left, top, right, bottom)"""
+        for position, patch in self._frame_patches(area):
+            canvas.paste(patch, position)
+
+
+@lru_cache(maxsize=None)
+def get_template(layout: CardLayout) -> CardTemplate:
+    """Шаблон макета, отрисованный один раз на процесс"""
+    return CardTemplate(layout)
@@ -8,6 +8,8 @@ load_dotenv()
 # Получаем переменные окружения
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Опционально: несколько ключей через запятую (см. ai_service.API_KEYS)
+GOOGLE_API_KEYS = os.getenv("GOOGLE_API_KEYS")
 ADMIN_ID_STR = os.getenv("ADMIN_ID", "0")
 
 # Проверка обязательных переменных окружения
@@ -17,9 +19,10 @@ if not BOT_TOKEN:
         "Для локальной разработки создайте файл .env с BOT_TOKEN=your_token"
     )
 
-if not GOOGLE_API_KEY:
+if not GOOGLE_API_KEY and not GOOGLE_API_KEYS:
     raise ValueError(
-        "GOOGLE_API_KEY не установлен! Установите переменную окружения GOOGLE_API_KEY.\n"
+        "GOOGLE_API_KEY не установлен! Установите переменную окружения GOOGLE_API_KEY "
+        "(или GOOGLE_API_KEYS со списком ключей через запятую).\n"
         "Для локальной разработки создайте файл .env с GOOGLE_API_KEY=your_key"
     )
 
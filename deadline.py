@@ -0,0 +1,50 @@
+"""
+Общий дедлайн задачи создания открытки.
+
+Создается, когда пользователь отправил текст, и передается через все этапы:
+очередь, генерацию, повторные попытки, сборку и отправку в Telegram.
+Каждый этап берет таймаут из оставшегося времени, а задачи, которые уже
+не успевают, прекращаются заранее.
+"""
+import os
+import time
+
+# Сколько секунд дается на всю открытку - от отправки текста до получения фото
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "120"))
+
+
+class DeadlineExceeded(Exception):
+    """Задача не успевает уложиться в дедлайн"""
+
+
+class Deadline:
+    """Момент, к которому задача должна завершиться."""
+
+    def __init__(self, budget: float = JOB_DEADLINE):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """Сколько секунд осталось (не меньше нуля)"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def reserve(self, seconds: float) -> "Deadline":
+        """Дедлайн этапа, который заканчивается на seconds раньше - остаток остается следующим этапам"""
+        stage = Deadline(max(0.0, self.budget - seconds))
+        stage.expires_at = self.expires_at - seconds
+        return stage
+
+    def timeout(self, cap: float = None, floor: float = 0.0) -> float:
+        """Таймаут этапа: оставшееся время, но не больше cap и не меньше floor"""
+        value = self.remaining()
+        if cap is not None:
+            value = min(value, cap)
+        return max(value, floor)
+
+    def ensure(self, needed: float = 0.0, stage: str = ""):
+        """Бросает DeadlineExceeded, если на этап нужно больше времени, чем осталось"""
+        remaining = self.remaining()
+        if remaining <= needed:
+            raise DeadlineExceeded(
+                f"{stage or 'stage'} needs {needed:.0f}s, only {remaining:.1f}s of {self.budget:.0f}s left"
+            )
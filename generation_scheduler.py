@@ -0,0 +1,172 @@
+"""
+Планировщик задач генерации AI-картинок.
+
+Стоит перед ai_service.generate_image_bytes: ограничивает число одновременных
+запросов к Gemini, раздает слоты по очереди между пользователями (round-robin),
+отклоняет новые задачи, когда очередь переполнена, и сообщает место в очереди.
+"""
+import os
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from deadline import DeadlineExceeded
+
+# --- КОНФИГУРАЦИЯ ---
+# Сколько генераций выполняется одновременно
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+# Сколько задач может ждать в очереди, остальные отклоняются
+GENERATION_MAX_QUEUE = int(os.getenv("GENERATION_MAX_QUEUE", "200"))
+
+
+class QueueFull(Exception):
+    """Очередь генерации переполнена - задача отклонена"""
+
+
+class _Job:
+    __slots__ = ("lane", "prompt", "deadline", "options", "future", "task", "moved")
+
+    def __init__(self, lane, prompt, deadline=None, options=None):
+        self.lane = lane
+        self.prompt = prompt
+        self.deadline = deadline
+        self.options = options or {}
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+        # Выставляется, когда очередь сдвинулась или задача запустилась
+        self.moved = asyncio.Event()
+
+    @property
+    def started(self) -> bool:
+        return self.task is not None
+
+
+class GenerationScheduler:
+    """Очередь генераций с ограничением параллельности и честной очередностью по пользователям."""
+
+    def __init__(self, worker, concurrency: int = GENERATION_CONCURRENCY, max_queue: int = GENERATION_MAX_QUEUE):
+        # worker: async функция (prompt, deadline, **options) -> результат (ai_service.generate_image_bytes)
+        self._worker = worker
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        # lane (обычно user_id) -> deque[_Job]; порядок ключей задает очередь round-robin
+        self._lanes = OrderedDict()
+        self._queued = 0
+        self._running = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def submit(self, lane, prompt: str, on_position=None, deadline=None, **options):
+        """
+        Ставит генерацию в очередь и ждет результат.
+        on_position - async функция, которой передается место в очереди (1 - следующая),
+        вызывается при каждом изменении места, пока задача ждет.
+        deadline - общий дедлайн задачи: если он истек в очереди, задача снимается.
+        options - дополнительные аргументы для worker.
+        Бросает QueueFull, если очередь переполнена, и DeadlineExceeded.
+        """
+        if self._queued >= self.max_queue:
+            raise QueueFull(f"Очередь генерации переполнена ({self._queued} задач)")
+        if deadline:
+            deadline.ensure(stage="generation queue")
+
+        job = _Job(lane, prompt, deadline, options)
+        self._lanes.setdefault(lane, deque()).append(job)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            last_position = None
+            while not job.started:
+                position = self.position(job)
+                if on_position and position != last_position:
+                    last_position = position
+                    try:
+                        await on_position(position)
+                    except Exception as e:
+                        logging.warning(f"Не удалось сообщить место в очереди: {e}")
+                job.moved.clear()
+                if not job.started:
+                    await asyncio.wait_for(job.moved.wait(), timeout=deadline.remaining() if deadline else None)
+            return await asyncio.shield(job.future)
+        except asyncio.TimeoutError:
+            # Дедлайн истек, пока задача стояла в очереди - освобождаем место для тех, кто успевает
+            self._abandon(job)
+            raise DeadlineExceeded("deadline expired in generation queue")
+        except asyncio.CancelledError:
+            self._abandon(job)
+            raise
+
+    def position(self, job: _Job) -> int:
+        """Место задачи в порядке запуска (1 - запустится следующей), 0 - уже запущена"""
+        if job.started:
+            return 0
+        jobs = self._lanes.get(job.lane)
+        if not jobs or job not in jobs:
+            return 0
+        index = jobs.index(job)
+        # Round-robin: из очередей до нашей заберут index + 1 задач, из очередей после - index
+        ahead = 0
+        before_own_lane = True
+        for lane, lane_jobs in self._lanes.items():
+            if lane == job.lane:
+                before_own_lane = False
+                continue
+            ahead += min(len(lane_jobs), index + 1 if before_own_lane else index)
+        return ahead + index + 1
+
+    def _abandon(self, job: _Job):
+        """Снимает задачу, если тот, кто ее ждал, отменился"""
+        if job.started:
+            job.task.cancel()
+            return
+        jobs = self._lanes.get(job.lane)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            self._queued -= 1
+            if not jobs:
+                del self._lanes[job.lane]
+            self._notify_queued()
+
+    def _dispatch(self):
+        started = False
+        while self._running < self.concurrency and self._lanes:
+            lane, jobs = next(iter(self._lanes.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._lanes.move_to_end(lane)
+            else:
+                del self._lanes[lane]
+            self._queued -= 1
+            self._running += 1
+            job.task = asyncio.create_task(self._run(job))
+            job.moved.set()
+            started = True
+        if started:
+            self._notify_queued()
+
+    def _notify_queued(self):
+        for jobs in self._lanes.values():
+            for job in jobs:
+                job.moved.set()
+
+    async def _run(self, job: _Job):
+        try:
+            result = await self._worker(job.prompt, job.deadline, **job.options)
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._running -= 1
+            self._dispatch()
@@ -0,0 +1,234 @@
+"""
+Дисковый кэш AI-фонов с адресацией по содержимому запроса.
+
+Ключ записи - sha256 от модели, промпта и варианта (для сгенерированных картинок -
+хэша самой картинки), значение - исходные байты картинки от Gemini. Файлы пишутся
+атомарно (временный файл + os.replace), общий размер ограничен, при переполнении
+удаляются давно не использованные записи (LRU). Индекс лежит рядом в index.json,
+сохраняется не чаще раза в INDEX_SAVE_INTERVAL секунд и при остановке и переживает
+перезапуск, поэтому после деплоя пул фонов можно наполнить с диска, а не генерировать заново.
+"""
+import os
+import json
+import mmap
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+# --- КОНФИГУРАЦИЯ ---
+# Папка кэша
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "images"))
+# Максимальный размер кэша в мегабайтах. 0 - кэш выключен
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+# Сколько секунд фон из кэша можно отдавать пользователям (для наполнения пула возраст не важен)
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(6 * 60 * 60)))
+
+INDEX_FILE = "index.json"
+# Индекс переписывается целиком, поэтому не чаще раза в столько секунд; записи, не попавшие
+# в индекс при падении, load() подберет по файлам
+INDEX_SAVE_INTERVAL = 30
+IMAGE_SUFFIX = ".img"
+
+
+def prompt_group(model: str, prompt: str) -> str:
+    """Хэш модели и промпта - общий для всех вариантов одного промпта"""
+    return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def cache_key(model: str, prompt: str, variant=None) -> str:
+    """Ключ записи: хэш модели, промпта и варианта"""
+    variant = "" if variant is None else str(variant)
+    return hashlib.sha256(f"{prompt_group(model, prompt)}\0{variant}".encode("utf-8")).hexdigest()
+
+
+def image_key(model: str, prompt: str, data: bytes) -> str:
+    """Ключ сгенерированной картинки: у каждой картинки промпта своя запись"""
+    return cache_key(model, prompt, hashlib.sha256(data).hexdigest())
+
+
+class ImageCache:
+    """
+    LRU-кэш картинок на диске. Методы синхронные и потокобезопасные -
+    из asyncio кода их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # key -> {"group": str | None, "size": int, "created": float}; порядок - от давно использованных к недавним
+        self._entries = OrderedDict()
+        self._size = 0
+        self._dirty = False
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + IMAGE_SUFFIX)
+
+    def load(self):
+        """Читает индекс и сверяет его с файлами на диске"""
+        if not self.enabled:
+            logging.info("Дисковый кэш фонов отключен (IMAGE_CACHE_MAX_MB=0)")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = []
+        except (OSError, ValueError) as e:
+            logging.warning(f"Индекс кэша фонов поврежден, восстанавливаю по файлам: {e}")
+            index = []
+
+        entries = OrderedDict()
+        for item in index:
+            try:
+                key = item["key"]
+                size = os.path.getsize(self._path(key))
+            except (KeyError, TypeError, OSError):
+                continue
+            entries[key] = {"group": item.get("group"), "size": size, "created": item.get("created", time.time())}
+
+        # Файлы, которые не попали в индекс (например, при падении между записью и сохранением индекса),
+        # подбираем как давно не использованные; недописанные временные файлы удаляем
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith(".tmp"):
+                    self._remove(path)
+                    continue
+                key = name[:-len(IMAGE_SUFFIX)]
+                if not name.endswith(IMAGE_SUFFIX) or key in entries:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries[key] = {"group": None, "size": stat.st_size, "created": stat.st_mtime}
+                entries.move_to_end(key, last=False)
+
+        with self._lock:
+            self._entries = entries
+            self._size = sum(entry["size"] for entry in entries.values())
+            self._dirty = True
+            self._evict()
+        self.save()
+        logging.info(f"🗄️ Кэш фонов: {len(self._entries)} картинок, {self._size // 1024} КБ")
+
+    def get(self, key: str, max_age: float = None):
+        """Возвращает байты картинки или None. max_age - не отдавать записи старше (секунды)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if max_age is not None and time.time() - entry["created"] > max_age:
+                return None
+            self._entries.move_to_end(key)
+            self._dirty = True
+        try:
+            # Читаем через mmap: одна копия из page cache, без промежуточных буферов файла
+            with open(self._path(key), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+        except (OSError, ValueError) as e:
+            logging.warning(f"Кэш фонов: не удалось прочитать {key}: {e}")
+            self._drop(key)
+            return None
+
+    def put(self, key: str, data: bytes, group: str = None):
+        """Атомарно сохраняет картинку и вытесняет старые записи сверх лимита"""
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+        except OSError as e:
+            logging.warning(f"Кэш фонов: не удалось сохранить {key}: {e}")
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old["size"]
+            self._entries[key] = {"group": group, "size": len(data), "created": time.time()}
+            self._size += len(data)
+            self._dirty = True
+            self._evict()
+        if time.monotonic() - self._saved_at >= INDEX_SAVE_INTERVAL:
+            self.save()
+
+    def find(self, *groups: str) -> list:
+        """Ключи всех записей указанных групп (вариантов промпта), начиная с самых свежих"""
+        groups = set(groups)
+        with self._lock:
+            matches = [(entry["created"], key) for key, entry in self._entries.items() if entry["group"] in groups]
+        return [key for _, key in sorted(matches, reverse=True)]
+
+    def age(self, key: str):
+        """Возраст записи в секундах или None"""
+        entry = self._entries.get(key)
+        return time.time() - entry["created"] if entry else None
+
+    def save(self):
+        """Сохраняет индекс, если он менялся"""
+        with self._lock:
+            if not self._dirty or not self.enabled:
+                return
+            index = [{"key": key, **entry} for key, entry in self._entries.items()]
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        path = os.path.join(self.directory, INDEX_FILE)
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Кэш фонов: не удалось сохранить индекс: {e}")
+            self._dirty = True
+
+    def _drop(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._size -= entry["size"]
+                self._dirty = True
+        self._remove(self._path(key))
+
+    def _evict(self):
+        # Вызывается под self._lock
+        while self._size > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._size -= entry["size"]
+            self._remove(self._path(key))
+        self._dirty = True
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
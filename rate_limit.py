@@ -0,0 +1,67 @@
+"""
+Ограничение частоты запросов: асинхронный token bucket с общей паузой.
+"""
+import time
+import asyncio
+
+
+class TokenBucket:
+    """
+    Token bucket: токены копятся со скоростью rate в секунду, но не больше capacity.
+    acquire() ждет, пока токен появится; pause() запрещает выдачу на время
+    (например, когда сервер прислал 429 и попросил подождать).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Ожидающие получают токены строго по очереди
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_time(self, tokens: float) -> float:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        """Ждет и забирает токены"""
+        async with self._lock:
+            while True:
+                delay = self._wait_time(tokens)
+                if delay <= 0:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (продлевает, но не сокращает паузу)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # После паузы начинаем с пустого ведра, чтобы не выстрелить всей пачкой сразу
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    @property
+    def paused_for(self) -> float:
+        """Сколько секунд осталось до конца паузы"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    @property
+    def available(self) -> float:
+        """Сколько токенов можно забрать прямо сейчас"""
+        if self.paused_for > 0:
+            return 0.0
+        self._refill(time.monotonic())
+        return self._tokens
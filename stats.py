@@ -0,0 +1,120 @@
+"""
+Статистика пользователей для админских команд.
+
+Все счетчики считаются одним запросом: общее число берется из дневной сводки
+users_daily (ее ведет триггер на users), новые за день/неделю/месяц - из диапазона
+по индексу (joined_at, user_id), первая и последняя регистрация - из краев того же
+индекса. Стоимость запроса зависит от числа регистраций за последний
+месяц, а не от размера таблицы. Результат кэшируется на несколько секунд.
+"""
+import os
+import time
+import asyncio
+from typing import NamedTuple, Optional
+from datetime import datetime
+
+# --- КОНФИГУРАЦИЯ ---
+# Сколько секунд админская статистика берется из кэша
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+
+# Регистрации без даты попадают в сводку под этим днем
+UNKNOWN_DAY = "1970-01-01"
+
+SCHEMA_SQL = f"""
+    -- Составной индекс обслуживает и статистику, и постраничный просмотр по (joined_at, user_id)
+    CREATE INDEX IF NOT EXISTS users_joined_at_user_id_idx ON users (joined_at, user_id);
+
+    CREATE TABLE IF NOT EXISTS users_daily (
+        day DATE PRIMARY KEY,
+        joined BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION users_daily_track() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE users_daily SET joined = joined - 1
+            WHERE day = COALESCE(OLD.joined_at::date, DATE '{UNKNOWN_DAY}');
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO users_daily (day, joined)
+            VALUES (COALESCE(NEW.joined_at::date, DATE '{UNKNOWN_DAY}'), 1)
+            ON CONFLICT (day) DO UPDATE SET joined = users_daily.joined + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Сводка заполняется по существующим строкам и триггер создается в одной транзакции под
+# блокировкой записи в users (ее берет ensure_schema), чтобы ни одна регистрация не потерялась
+# и не посчиталась дважды
+BACKFILL_SQL = f"""
+    DELETE FROM users_daily;
+    INSERT INTO users_daily (day, joined)
+        SELECT COALESCE(joined_at::date, DATE '{UNKNOWN_DAY}'), COUNT(*) FROM users GROUP BY 1;
+    CREATE TRIGGER users_daily_track
+        AFTER INSERT OR DELETE OR UPDATE OF joined_at ON users
+        FOR EACH ROW EXECUTE FUNCTION users_daily_track();
+"""
+
+STATS_SQL = """
+    SELECT
+        (SELECT COALESCE(SUM(joined), 0) FROM users_daily) AS total,
+        COUNT(*) FILTER (WHERE joined_at >= NOW() - INTERVAL '1 day') AS today,
+        COUNT(*) FILTER (WHERE joined_at >= NOW() - INTERVAL '7 days') AS week,
+        COUNT(*) AS month,
+        (SELECT MIN(joined_at) FROM users) AS first_joined,
+        (SELECT MAX(joined_at) FROM users) AS last_joined
+    FROM users
+    WHERE joined_at >= NOW() - INTERVAL '30 days'
+"""
+
+
+class UserStats(NamedTuple):
+    """Счетчики пользователей"""
+    total: int
+    today: int
+    week: int
+    month: int
+    first_joined: Optional[datetime]
+    last_joined: Optional[datetime]
+
+
+async def ensure_schema(conn):
+    """Создает индекс, сводку users_daily и триггер; при первом запуске заполняет сводку"""
+    await conn.execute(SCHEMA_SQL)
+    async with conn.transaction():
+        # Блокировка конфликтует сама с собой: второй экземпляр, стартующий одновременно,
+        # ждет здесь и после коммита первого уже видит триггер
+        await conn.execute("LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE")
+        exists = await conn.fetchval(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'users_daily_track' AND tgrelid = 'users'::regclass"
+        )
+        if not exists:
+            await conn.execute(BACKFILL_SQL)
+
+
+class UserStatistics:
+    """Статистика пользователей с коротким кэшем; одновременные запросы ждут один и тот же расчет."""
+
+    def __init__(self, ttl: float = STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._expires_at = 0.0
+
+    async def get(self, pool) -> UserStats:
+        """Возвращает статистику из кэша или считает ее одним запросом"""
+        if self._value is not None and time.monotonic() < self._expires_at:
+            return self._value
+        async with self._lock:
+            if self._value is not None and time.monotonic() < self._expires_at:
+                return self._value
+            async with pool.acquire() as conn:
+                row = await conn.fetchrow(STATS_SQL)
+            self._value = UserStats(**dict(row))
+            self._expires_at = time.monotonic() + self.ttl
+            return self._value
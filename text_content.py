@@ -2,6 +2,10 @@
 Содержит тексты, конфигурации кнопок и логику сборки промптов
 для создания поздравительных открыток.
 """
+import re
+import random
+import hashlib
+from types import MappingProxyType
 
 # --- CONSTANTS ---
 COUNTRIES = {
@@ -12,6 +16,9 @@ COUNTRIES = {
     "philippines": "🇵🇭 Филиппины"
 }
 
+# Текст открытки, когда пользователь выбрал "Использовать шаблон текста"
+DEFAULT_CARD_TEXT = "Season's Greetings and best wishes for a prosperous and successful New Year!"
+
 # --- PROMPT PARTS ---
 GLOBAL_SAFETY = """
 GLOBAL SAFETY PROTOCOL (UAE & KSA):
@@ -250,132 +257,208 @@ CRITICAL COMPOSITION REQUIREMENTS:
     }
 }
 
-# --- LOGIC HELPERS ---
+# --- PROMPT VARIANTS ---
+# Промпты задают вариативность двумя способами:
+#   [Varies: a | b | c]                          - вариант прямо в строке;
+#   "... [THE AI MUST RANDOMLY SELECT ONE]:"     - блок, за которым идут строки "[Название]: ...".
+# Раньше выбор оставался модели, и один и тот же промпт давал непредсказуемые картинки.
+# Теперь варианты выбираются здесь: у каждого конкретного промпта есть стабильный номер
+# варианта, поэтому кэш, объединение запросов и пул фонов работают по вариантам.
 
-def get_tips(country: str) -> str:
-    """Возвращает экспертный совет на основе страны"""
-    # UAE
-    if country == "uae":
-        return "💡 Рекомендации:\n- ОАЭ это котел культур. В Дубае символы католического рождества повсюду. Но в других Эмиратах их гораздо меньше или нет вовсе.\n- В поздравлениях избегайте упоминания Рождества и религиозных символов, придерживайтесь поздравлений с Новым годом.\n- Этот бот сейчас умеет делать открытки для Эмирати или смешанных групп. Но помните, что в ОАЭ живет огромное число экспатов и они могут иметь свои особые традиции. Например, большинство Филиппинцев празднуют рождество 25-го декабря, также как европейцы или американцы, но со своими атрибутами и символами."
+_INLINE_VARIANT_RE = re.compile(r"\[Varies:\s*([^\]]*)\]")
+_BLOCK_VARIANT_MARKER = "[THE AI MUST RANDOMLY SELECT ONE]"
+_BLOCK_OPTION_RE = re.compile(r"^\[[^\]]+\]:")
+
+
+class PromptTemplate:
+    """
+    Шаблон промпта, разобранный на неизменяемые части и точки выбора.
+    Номер варианта - число в смешанной системе счисления по точкам выбора
+    (от 0 до count - 1), так что каждому номеру соответствует ровно один промпт.
+    """
+
+    def __init__(self, text: str):
+        # Части шаблона: str - текст как есть, tuple - варианты на выбор
+        self.parts = self._parse(text)
+        self.choices = [part for part in self.parts if isinstance(part, tuple)]
+        self.count = 1
+        for options in self.choices:
+            self.count *= len(options)
+
+    @staticmethod
+    def _parse(text: str) -> list:
+        parts = []
+        literal = []
+        lines = text.split("\n")
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if _BLOCK_VARIANT_MARKER in line:
+                # Заголовок блока оставляем без указания модели, из строк-вариантов выбирается одна
+                literal.append(line.replace(" " + _BLOCK_VARIANT_MARKER, "").replace(_BLOCK_VARIANT_MARKER, "") + "\n")
+                options = []
+                i += 1
+                while i < len(lines) and _BLOCK_OPTION_RE.match(lines[i]):
+                    options.append(lines[i] + "\n")
+                    i += 1
+                if options:
+                    parts.append("".join(literal))
+                    parts.append(tuple(options))
+                    literal = []
+                continue
+            last_end = 0
+            for match in _INLINE_VARIANT_RE.finditer(line):
+                options = tuple(option.strip() for option in match.group(1).split("|") if option.strip())
+                literal.append(line[last_end:match.start()])
+                parts.append("".join(literal))
+                parts.append(options)
+                literal = []
+                last_end = match.end()
+            literal.append(line[last_end:] + ("\n" if i < len(lines) - 1 else ""))
+            i += 1
+        parts.append("".join(literal))
+        return [part for part in parts if part != ""]
+
+    def indices(self, variant: int) -> list:
+        """Номер варианта -> выбранный индекс в каждой точке выбора"""
+        if not 0 <= variant < self.count:
+            raise ValueError(f"Invalid variant: {variant} (template has {self.count})")
+        result = []
+        for options in reversed(self.choices):
+            variant, index = divmod(variant, len(options))
+            result.append(index)
+        return result[::-1]
+
+    def render(self, variant: int = 0) -> str:
+        """Конкретный промпт для номера варианта"""
+        chosen = iter(self.indices(variant))
+        return "".join(part if isinstance(part, str) else part[next(chosen)] for part in self.parts)
 
-    # KSA
-    if country == "ksa":
-        return "💡 Рекомендации:\n- Саудовская Аравия - страна глубоких исламских традиций, но быстрых перемен. Рождество здесь не празднуют, и поздравлять с ним местных партнеров нельзя.\n- 1 января не является официальным народным праздником, но в бизнес-среде и крупных городах к нему относятся лояльно, часто в контексте фестиваля Riyadh Season.\n- Для поздравления используйте нейтральные формулировки про Новый год без религиозного подтекста и упоминаний или изображений алкоголя."
 
-    # India
-    if country == "india":
-        return "💡 Рекомендации:\n- Западный Новый год отмечают в основном в крупных городах и бизнес среде.\n- В каждом штате Индии отмечают свой индуистский или другой традиционный новый год, спросите вашего коллегу из какого он штата и какой праздник для него - Новый год. Не забудьте поздравить его в соответствующую дату.\n- Индия - невероятно разнообразная в языковом смысле страна, поэтому мы рекомендуем ограничиться английским, так как не известно, владеет ли ваш коллега хинди, тамильским или керала."
+def pick_variant(count: int, seed=None) -> int:
+    """
+    Номер варианта: детерминированно по seed (одинаково в любом процессе),
+    а без seed - случайно, чтобы пользователи видели разнообразие.
+    """
+    if count <= 1:
+        return 0
+    if seed is None:
+        return random.randrange(count)
+    digest = hashlib.sha256(str(seed).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
 
-    # China
-    if country == "china":
-        return "💡 Рекомендации:\n- В Китае Новый год это второстепенный праздник по сравнению с Лунным новым годом. В 2026 году Лунный новый год выпадает на 17 февраля, а праздники продлятся с 16 февраля до 3 марта. Обязательно поздравьте ваших коллег с Лунным новым годом.\n- Новый год в западном стиле отмечают только в крупных городах.\n- Не поздравляйте ваших китайских коллег с Рождеством, даже если они проживают на западе."
 
-    # Philippines
-    if country == "philippines":
-        return "💡 Рекомендации:\n- Филиппины - страна с самой длинной рождественской традицией в Азии. Рождество здесь начинается в сентябре и длится до января, поэтому поздравления с Рождеством и Новым годом здесь нормальны и приветствуются.\n- Новый год отмечают с особой радостью, часто с шумными фейерверками и обильным застольем с 12 видами фруктов (символ 12 месяцев изобилия).\n- Филиппинцы ценят теплоту и изобилие в поздравлениях. Изображения алкоголя (шампанское, вино) допустимы и даже приветствуются.\n- Важна символика изобилия (Masagana) - избегайте минимализма, предпочитайте яркие, наполненные композиции."
+PROMPT_TEMPLATES = {code: PromptTemplate(topic["prompt"]) for code, topic in TOPICS.items()}
 
-    return "💡 **Совет:** Помните золотое правило: Будьте уважительны, исключайте изображения алкоголя и религиозные элементы, фокусируйтесь на общих ценностях, таких как процветание, свет и тепло."
 
-def get_available_topics(country: str):
+def get_variant_count(topic_code: str) -> int:
+    """Сколько конкретных вариантов у промпта темы"""
+    return PROMPT_TEMPLATES[topic_code].count
+
+# --- LOGIC HELPERS ---
+# Все, что зависит только от страны и темы, собирается один раз при импорте в неизменяемые
+# таблицы - хэндлеры и генерация делают только поиск по словарю/множеству.
+
+# Экспертные советы по странам
+TIPS = MappingProxyType({
+    "uae": "💡 Рекомендации:\n- ОАЭ это котел культур. В Дубае символы католического рождества повсюду. Но в других Эмиратах их гораздо меньше или нет вовсе.\n- В поздравлениях избегайте упоминания Рождества и религиозных символов, придерживайтесь поздравлений с Новым годом.\n- Этот бот сейчас умеет делать открытки для Эмирати или смешанных групп. Но помните, что в ОАЭ живет огромное число экспатов и они могут иметь свои особые традиции. Например, большинство Филиппинцев празднуют рождество 25-го декабря, также как европейцы или американцы, но со своими атрибутами и символами.",
+    "ksa": "💡 Рекомендации:\n- Саудовская Аравия - страна глубоких исламских традиций, но быстрых перемен. Рождество здесь не празднуют, и поздравлять с ним местных партнеров нельзя.\n- 1 января не является официальным народным праздником, но в бизнес-среде и крупных городах к нему относятся лояльно, часто в контексте фестиваля Riyadh Season.\n- Для поздравления используйте нейтральные формулировки про Новый год без религиозного подтекста и упоминаний или изображений алкоголя.",
+    "india": "💡 Рекомендации:\n- Западный Новый год отмечают в основном в крупных городах и бизнес среде.\n- В каждом штате Индии отмечают свой индуистский или другой традиционный новый год, спросите вашего коллегу из какого он штата и какой праздник для него - Новый год. Не забудьте поздравить его в соответствующую дату.\n- Индия - невероятно разнообразная в языковом смысле страна, поэтому мы рекомендуем ограничиться английским, так как не известно, владеет ли ваш коллега хинди, тамильским или керала.",
+    "china": "💡 Рекомендации:\n- В Китае Новый год это второстепенный праздник по сравнению с Лунным новым годом. В 2026 году Лунный новый год выпадает на 17 февраля, а праздники продлятся с 16 февраля до 3 марта. Обязательно поздравьте ваших коллег с Лунным новым годом.\n- Новый год в западном стиле отмечают только в крупных городах.\n- Не поздравляйте ваших китайских коллег с Рождеством, даже если они проживают на западе.",
+    "philippines": "💡 Рекомендации:\n- Филиппины - страна с самой длинной рождественской традицией в Азии. Рождество здесь начинается в сентябре и длится до января, поэтому поздравления с Рождеством и Новым годом здесь нормальны и приветствуются.\n- Новый год отмечают с особой радостью, часто с шумными фейерверками и обильным застольем с 12 видами фруктов (символ 12 месяцев изобилия).\n- Филиппинцы ценят теплоту и изобилие в поздравлениях. Изображения алкоголя (шампанское, вино) допустимы и даже приветствуются.\n- Важна символика изобилия (Masagana) - избегайте минимализма, предпочитайте яркие, наполненные композиции.",
+})
+DEFAULT_TIP = "💡 **Совет:** Помните золотое правило: Будьте уважительны, исключайте изображения алкоголя и религиозные элементы, фокусируйтесь на общих ценностях, таких как процветание, свет и тепло."
+
+# Доступные темы по странам (порядок - порядок кнопок)
+AVAILABLE_TOPICS = MappingProxyType({
+    "india": ("mandala", "modern_royal", "urban_vibes"),
+    "china": ("prosperity", "abundance", "light_happiness"),
+    "philippines": ("fruit_burst", "light_abstract"),
+})
+# Для UAE и KSA: time, fireworks
+DEFAULT_TOPICS = ("time", "fireworks")
+
+# Safety protocol по странам
+SAFETY_PROTOCOLS = MappingProxyType({
+    "india": GLOBAL_SAFETY_INDIA,
+    "china": GLOBAL_SAFETY_CHINA,
+    "philippines": GLOBAL_SAFETY_PHILIPPINES,
+})
+
+def get_tips(country: str) -> str:
+    """Возвращает экспертный совет на основе страны"""
+    return TIPS.get(country, DEFAULT_TIP)
+
+def get_available_topics(country: str) -> tuple:
     """Возвращает доступные топики в зависимости от страны"""
-    if country == "india":
-        # Для Индии: mandala, modern_royal, urban_vibes
-        return ["mandala", "modern_royal", "urban_vibes"]
-    elif country == "china":
-        # Для Китая: prosperity, abundance, light_happiness
-        return ["prosperity", "abundance", "light_happiness"]
-    elif country == "philippines":
-        # Для Филиппин: fruit_burst, light_abstract
-        return ["fruit_burst", "light_abstract"]
-    else:
-        # Для UAE и KSA: time, fireworks
-        return ["time", "fireworks"]
-
-def build_final_prompt(country_code, topic_code):
-    """Сборка финального промпта для AI"""
-    import json
-    import os
-    
-    # #region agent log
-    # Debug logging (опционально, только для локальной разработки)
-    DEBUG_LOG_ENABLED = os.getenv("DEBUG_LOG_ENABLED", "false").lower() == "true"
-    if DEBUG_LOG_ENABLED:
-        DEBUG_LOG_PATH = os.path.join(os.getcwd(), ".cursor", "debug.log")
-        try:
-            log_dir = os.path.dirname(DEBUG_LOG_PATH)
-            if log_dir and not os.path.exists(log_dir):
-                os.makedirs(log_dir, exist_ok=True)
-            
-            log_entry = {
-                "sessionId": "debug-session",
-                "runId": "run1",
-                "hypothesisId": "C",
-                "location": "text_content.py:227",
-                "message": "build_final_prompt ENTRY",
-                "data": {"country_code": country_code, "topic_code": topic_code},
-                "timestamp": 0
-            }
-            with open(DEBUG_LOG_PATH, "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
-        except Exception:
-            pass  # Игнорируем ошибки логирования
-    # #endregion
-    
-    # ВАЛИДАЦИЯ входных параметров (гипотеза C)
-    if country_code not in COUNTRIES:
-        raise ValueError(f"Invalid country_code: {country_code}")
-    if topic_code not in TOPICS:
-        raise ValueError(f"Invalid topic_code: {topic_code}")
-    
-    # #region agent log
-    if DEBUG_LOG_ENABLED:
-        try:
-            avail_topics = get_available_topics(country_code)
-            log_entry = {
-                "sessionId": "debug-session",
-                "runId": "run1",
-                "hypothesisId": "C",
-                "location": "text_content.py:245",
-                "message": "build_final_prompt VALIDATION",
-                "data": {"country": country_code, "topic": topic_code, "available_topics": avail_topics, "is_valid": topic_code in avail_topics},
-                "timestamp": 0
-            }
-            with open(DEBUG_LOG_PATH, "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
-        except Exception:
-            pass  # Игнорируем ошибки логирования
-    # #endregion
-    
-    # 1. Достаем данные
-    c_data = COUNTRY_AESTHETICS.get(country_code, "")
-    t_data = TOPICS[topic_code]["prompt"]
-    
-    # 2. Выбираем правильный safety protocol в зависимости от страны
-    if country_code == "india":
-        safety_protocol = GLOBAL_SAFETY_INDIA
-    elif country_code == "china":
-        safety_protocol = GLOBAL_SAFETY_CHINA
-    elif country_code == "philippines":
-        safety_protocol = GLOBAL_SAFETY_PHILIPPINES
-    else:
-        safety_protocol = GLOBAL_SAFETY
-    
-    # 3. Контекст страны
-    country_context = c_data
+    return AVAILABLE_TOPICS.get(country, DEFAULT_TOPICS)
 
-    # 4. Структура: Subject -> Colors (Country) -> Safety
-    
-    full_prompt = (
+def _compose_prompt(country_code: str, topic_code: str, variant: int) -> str:
+    # Структура: Subject -> Colors (Country) -> Safety
+    return (
         f"--- ROLE & TASK ---\n"
-        f"{t_data}\n\n"
+        f"{PROMPT_TEMPLATES[topic_code].render(variant)}\n\n"
         
         f"--- COLOR PALETTE & SETTING ---\n"
-        f"Country Context: {country_context}\n"
+        f"Country Context: {COUNTRY_AESTHETICS.get(country_code, '')}\n"
         f"Use the Color Palette of {COUNTRIES[country_code]}.\n\n"
         
         f"--- TECHNICAL CONSTRAINTS & SAFETY ---\n"
         f"VIEW: Full-screen digital art, edge-to-edge. NO physical card on a table. No borders.\n"
-        f"{safety_protocol}"
+        f"{SAFETY_PROTOCOLS.get(country_code, GLOBAL_SAFETY)}"
     )
+
+# Темы страны: множество для проверок и словарь для клавиатур
+COUNTRY_TOPIC_SETS = MappingProxyType({
+    country: frozenset(get_available_topics(country)) for country in COUNTRIES
+})
+COUNTRY_TOPICS = MappingProxyType({
+    country: MappingProxyType({topic: TOPICS[topic] for topic in get_available_topics(country)})
+    for country in COUNTRIES
+})
+
+# Все готовые промпты: (country, topic, variant) -> промпт
+PROMPTS = MappingProxyType({
+    (country, topic, variant): _compose_prompt(country, topic, variant)
+    for country in COUNTRIES
+    for topic in get_available_topics(country)
+    for variant in range(PROMPT_TEMPLATES[topic].count)
+})
+
+def is_topic_available(country: str, topic: str) -> bool:
+    """Доступна ли тема для страны"""
+    topics = COUNTRY_TOPIC_SETS.get(country)
+    return topics is not None and topic in topics
+
+def get_country_topics(country: str):
+    """Темы страны в порядке кнопок: topic -> данные темы (только чтение)"""
+    return COUNTRY_TOPICS.get(country) or MappingProxyType({topic: TOPICS[topic] for topic in get_available_topics(country)})
+
+def build_final_prompt(country_code, topic_code, variant: int = None, seed=None):
+    """
+    Сборка финального промпта для AI.
+    Возвращает (промпт, номер варианта). variant задает вариант явно, иначе он
+    выбирается по seed (детерминированно) или случайно, если seed не передан.
+    """
+    # ВАЛИДАЦИЯ входных параметров
+    if country_code not in COUNTRIES:
+        raise ValueError(f"Invalid country_code: {country_code}")
+    if topic_code not in TOPICS:
+        raise ValueError(f"Invalid topic_code: {topic_code}")
     
-    return full_prompt
+    template = PROMPT_TEMPLATES[topic_code]
+    if variant is None:
+        variant = pick_variant(template.count, seed)
+    prompt = PROMPTS.get((country_code, topic_code, variant))
+    if prompt is None:
+        # Тема не из списка страны - такой промпт не предсобран
+        template.indices(variant)
+        prompt = _compose_prompt(country_code, topic_code, variant)
+    return prompt, variant
+
+def build_variant_prompts(country_code, topic_code) -> list:
+    """Промпты всех вариантов темы: дисковый кэш хранит фоны по конкретному варианту"""
+    return [
+        build_final_prompt(country_code, topic_code, variant=variant)[0]
+        for variant in range(get_variant_count(topic_code))
+    ]